@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+# Copyright 2020-2024 src_prepare group
+# Distributed under the terms of the GNU General Public License v2
+
+"""
+Measure handlers throughput, latency and allocations offline, against
+recorded upstream responses replayed by a local fixture server.
+
+Usage: python bench/benchmark.py [--iterations N] [--handlers a,b]
+                                 [--packages atom,...] [--json FILE]
+       python bench/benchmark.py --record
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from replay import (  # noqa: E402
+    FixtureFTPServer,
+    Fixtures,
+    FixtureServer,
+    ReplayHandler,
+)
+
+# name, handler, kind, cpv, url or (url, options) for url handlers, options for
+# package handlers
+CASES = [
+    (
+        "pypi",
+        "pypi",
+        "pkg",
+        "dev-python/six-1.16.0",
+        {"data": "six"},
+    ),
+    (
+        "gnome",
+        "gnome",
+        "pkg",
+        "dev-util/gtk-doc-1.32",
+        {"data": "gtk-doc"},
+    ),
+    (
+        "gitlab",
+        "gitlab",
+        "url",
+        "media-gfx/inkscape-1.2.2",
+        "https://gitlab.com/inkscape/inkscape/-/archive/1.2.2/inkscape-1.2.2.tar.bz2",
+    ),
+    (
+        "gitea",
+        "gitea",
+        "url",
+        "www-apps/forgejo-8.0.3",
+        (
+            "https://codeberg.org/forgejo/forgejo/archive/v8.0.3.tar.gz",
+            # Tags are prefixed with a v, as in the metadata.xml of the package
+            {"versionmangle": ["s/^v//", "gentoo"]},
+        ),
+    ),
+    (
+        "github",
+        "github",
+        "url",
+        "app-misc/jq-1.6",
+        "https://github.com/jqlang/jq/releases/download/jq-1.6/jq-1.6.tar.gz",
+    ),
+    (
+        "cpan",
+        "cpan",
+        "pkg",
+        "dev-perl/Try-Tiny-0.30",
+        {"data": "Try-Tiny"},
+    ),
+    (
+        "rubygems",
+        "rubygems",
+        "pkg",
+        "dev-ruby/rake-13.0.6",
+        {"data": "rake"},
+    ),
+    (
+        "pecl",
+        "pecl",
+        "pkg",
+        "dev-php/pecl-apcu-5.1.22",
+        {"data": "APCu", "type": "pecl"},
+    ),
+    (
+        "sourceforge",
+        "sourceforge",
+        "url",
+        "sys-process/mtop-0.6.6",
+        "mirror://sourceforge/mtop/mtop-0.6.6.tar.gz",
+    ),
+    (
+        "deb",
+        "deb",
+        "pkg",
+        "app-misc/hello-2.10",
+        {
+            "data": "http://deb.debian.org/debian/dists/sid/main/binary-all/"
+            "Packages.gz hello"
+        },
+    ),
+    (
+        "generic-apache",
+        "generic",
+        "url",
+        "app-misc/hello-2.10",
+        "https://ftp.gnu.org/gnu/hello/hello-2.10.tar.gz",
+    ),
+    (
+        "generic-ftp",
+        "generic",
+        "url",
+        "app-misc/hello-2.10",
+        "ftp://ftp.gnu.org/gnu/hello/hello-2.10.tar.gz",
+    ),
+]
+
+
+class BenchPackage:
+    """
+    The subset of gentoolkit's Package used by handlers
+    """
+
+    def __init__(self, cpv):
+        import portage
+
+        self.cpv = cpv
+        self.cp, self.version, self.revision = portage.pkgsplit(cpv)
+        self.category, self.name = self.cp.split("/")
+
+
+def reset():
+    """
+    Forget everything fetched by previous iterations
+    """
+    from euscan import (
+        breaker,
+        cache,
+        ftp,
+        handlers,
+        helpers,
+        latency,
+        metadata,
+        mirrors,
+        resolver,
+    )
+
+    helpers.reset_indexes()
+    cache.reset()
+    resolver.reset()
+    latency.reset()
+    breaker.reset()
+    ftp.close()
+    mirrors.reset()
+    metadata.reset()
+    handlers.reset()
+
+
+def replay_ftp(address):
+    """
+    Send the FTP sessions to the fixture FTP server at address, logging
+    in as user@host. Returns the function to call to stop doing so
+    """
+    from euscan import ftp
+
+    connect = ftp._connect
+
+    def replay_connect(host, port, user, password, timeout):
+        return connect(*address[:2], f"{user}@{host}", password, timeout)
+
+    ftp._connect = replay_connect
+
+    def stop():
+        ftp._connect = connect
+
+    return stop
+
+
+def run_case(case):
+    from euscan import handlers
+
+    name, handler_name, kind, cpv, arg = case
+    handler = handlers.handlers["all"][handler_name]
+    pkg = BenchPackage(cpv)
+
+    if kind == "url":
+        url, options = arg if isinstance(arg, tuple) else (arg, {})
+        return handler.scan_url(pkg, url, dict(options))
+    return handler.scan_pkg(pkg, dict(arg))
+
+
+def run_upstream(query):
+    from euscan import output
+    from euscan.scan import scan_upstream
+
+    output.set_query(query)
+    try:
+        return scan_upstream(query) or []
+    finally:
+        output.set_query(None)
+        output.clean()
+
+
+def measure(function, arg, server, replay, iterations, warm, ftp_server):
+    """
+    Run function(arg) iterations times, then once more under tracemalloc
+    """
+    latencies = []
+    requests = len(server.requests)
+    received = replay.bytes_received + ftp_server.bytes_sent
+    identity, sent = server.bytes_identity, server.bytes_sent
+    results = []
+    error = None
+
+    for _i in range(iterations):
+        if not warm:
+            reset()
+        start = time.perf_counter()
+        try:
+            results = function(arg)
+        except Exception as e:
+            error = f"{e.__class__.__name__}: {e}"
+            break
+        latencies.append(time.perf_counter() - start)
+
+    stats = {
+        "iterations": len(latencies),
+        "requests": (len(server.requests) - requests) / max(len(latencies), 1),
+        "bytes": (replay.bytes_received + ftp_server.bytes_sent - received)
+        / max(len(latencies), 1),
+        # Saved by content coding, compared to uncompressed responses
+        "saved": (
+            (server.bytes_identity - identity) - (server.bytes_sent - sent)
+        )
+        / max(len(latencies), 1),
+        "results": len(results or []),
+        "error": error,
+    }
+
+    if latencies:
+        latencies.sort()
+        total = sum(latencies)
+        stats.update(
+            {
+                "calls_per_second": len(latencies) / total if total else 0,
+                "mean_ms": statistics.mean(latencies) * 1000,
+                "p95_ms": latencies[int(0.95 * (len(latencies) - 1))] * 1000,
+            }
+        )
+
+        if not warm:
+            reset()
+        tracemalloc.start()
+        try:
+            function(arg)
+        except Exception:
+            pass
+        snapshot = tracemalloc.take_snapshot()
+        stats["peak_kib"] = tracemalloc.get_traced_memory()[1] / 1024
+        stats["allocated_blocks"] = sum(
+            stat.count for stat in snapshot.statistics("filename")
+        )
+        tracemalloc.stop()
+
+    return stats
+
+
+def print_report(results):
+    columns = (
+        ("name", "%-24s", "%-24.24s"),
+        ("calls_per_second", "%10s", "%10.1f"),
+        ("mean_ms", "%9s", "%9.2f"),
+        ("p95_ms", "%9s", "%9.2f"),
+        ("requests", "%9s", "%9.1f"),
+        ("bytes", "%10s", "%10.0f"),
+        ("saved", "%10s", "%10.0f"),
+        ("peak_kib", "%10s", "%10.1f"),
+        ("results", "%8s", "%8d"),
+    )
+
+    print(" ".join(header % column for column, header, _ in columns))
+    for stats in results:
+        if stats.get("error") and not stats["iterations"]:
+            print("%-24s %s" % (stats["name"], stats["error"]))
+            continue
+        print(" ".join(value % stats.get(column, 0) for column, _, value in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--handlers", help="comma-separated list of cases to run")
+    parser.add_argument(
+        "--packages",
+        help="comma-separated list of packages to scan end-to-end with "
+        "scan_upstream(), using the local tree",
+    )
+    parser.add_argument(
+        "--warm", action="store_true", help="keep per-run caches between iterations"
+    )
+    parser.add_argument("--cache", help="cache directory to use")
+    parser.add_argument("--json", help="also write results to this file")
+    parser.add_argument(
+        "--record", action="store_true", help="refresh fixtures from live upstreams"
+    )
+    args = parser.parse_args()
+
+    fixtures = Fixtures()
+
+    if args.record:
+        fixtures.record()
+        return
+
+    from euscan import CONFIG, helpers
+
+    CONFIG["quiet"] = True
+    CONFIG["verbose"] = 0
+    CONFIG["skip-robots-txt"] = True
+    CONFIG["cache"] = args.cache or False
+
+    server = FixtureServer(fixtures).start()
+    replay = ReplayHandler(server.server_address)
+    helpers.opener_handlers.append(replay)
+    ftp_server = FixtureFTPServer(fixtures, requests=server.requests).start()
+    stop_ftp = replay_ftp(ftp_server.server_address)
+
+    results = []
+    try:
+        selected = args.handlers.split(",") if args.handlers else None
+        for case in CASES:
+            if selected and case[0] not in selected:
+                continue
+            stats = measure(
+                run_case, case, server, replay, args.iterations, args.warm, ftp_server
+            )
+            stats["name"] = case[0]
+            results.append(stats)
+
+        if args.packages:
+            CONFIG["format"] = "dict"
+            queries = args.packages.split(",")
+            for query in queries:
+                stats = measure(
+                    run_upstream,
+                    query,
+                    server,
+                    replay,
+                    args.iterations,
+                    args.warm,
+                    ftp_server,
+                )
+                stats["name"] = f"scan_upstream {query}"
+                results.append(stats)
+    finally:
+        helpers.opener_handlers.remove(replay)
+        stop_ftp()
+        server.stop()
+        ftp_server.stop()
+
+    print_report(results)
+
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
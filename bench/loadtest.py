@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# Copyright 2020-2024 src_prepare group
+# Distributed under the terms of the GNU General Public License v2
+
+"""
+Run the scanning pipeline over thousands of synthetic packages against
+a local mock upstream, and report throughput.
+
+Usage: python bench/loadtest.py [--packages N] [--jobs N]
+                                [--mix dir=60,head=25,...] [--latency S]
+"""
+
+import argparse
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mockupstream import PROFILES, MockUpstream, package_versions  # noqa: E402
+from replay import ReplayHandler  # noqa: E402
+
+DEFAULT_MIX = "dir=60,head=25,slow=5,hang=2,ratelimit=4,broken=4"
+
+
+class SyntheticPackage:
+    """
+    The subset of gentoolkit's Package used by scan_package()
+    """
+
+    def __init__(self, i, profile, hosts):
+        self.name = f"pkg{i}"
+        self.category = f"bench-{profile}"
+        self.version, _versions = package_versions(self.name)
+        self.revision = "r0"
+        self.cp = f"{self.category}/{self.name}"
+        self.cpv = f"{self.cp}-{self.version}"
+        self.profile = profile
+        self._env = {
+            "SRC_URI": f"http://h{i % hosts}.{profile}.mock/releases/{self.name}/"
+            f"{self.name}-{self.version}.tar.gz",
+            "HOMEPAGE": f"http://h{i % hosts}.{profile}.mock/",
+            "DESCRIPTION": "Synthetic package",
+        }
+
+    def environment(self, envvars):
+        if isinstance(envvars, str):
+            return self._env[envvars]
+        return [self._env[var] for var in envvars]
+
+    def repo_name(self):
+        return "bench"
+
+    def ebuild_path(self):
+        return None
+
+
+def generate_packages(count, mix, hosts):
+    weights = []
+    for item in mix.split(","):
+        profile, weight = item.split("=")
+        if profile not in PROFILES:
+            raise ValueError(f"Unknown profile {profile}")
+        weights += [profile] * int(weight)
+
+    return [(i, weights[i % len(weights)], hosts) for i in range(count)]
+
+
+def init_worker(address, config):
+    from euscan import CONFIG, helpers
+
+    CONFIG.update(config)
+    helpers.opener_handlers.append(ReplayHandler(address))
+
+
+def scan(args):
+    from euscan import output
+    from euscan.scan import scan_package
+
+    pkg = SyntheticPackage(*args)
+
+    output.set_query(pkg.cpv)
+    start = time.perf_counter()
+    error = None
+    try:
+        result = scan_package(pkg) or []
+    except Exception as e:
+        result = []
+        error = f"{e.__class__.__name__}: {e}"
+    elapsed = time.perf_counter() - start
+    output.set_query(None)
+    output.clean()
+
+    return pkg.profile, elapsed, len(result), error
+
+
+def print_report(stats, elapsed, requests):
+    total = len(stats)
+    total_requests = sum(requests.values())
+
+    print(
+        f"{total} packages in {elapsed:.1f}s: {total / elapsed:.1f} packages/s, "
+        f"{total_requests} requests, {total_requests / elapsed:.1f} requests/s"
+    )
+    print()
+    print(
+        "%-10s %8s %8s %8s %9s %9s %9s"
+        % ("profile", "packages", "found", "errors", "mean_s", "p95_s", "requests")
+    )
+    for profile in PROFILES:
+        elapsed = sorted(s[1] for s in stats if s[0] == profile)
+        if not elapsed:
+            continue
+        found = sum(1 for s in stats if s[0] == profile and s[2])
+        errors = sum(1 for s in stats if s[0] == profile and s[3])
+        print(
+            "%-10s %8d %8d %8d %9.3f %9.3f %9d"
+            % (
+                profile,
+                len(elapsed),
+                found,
+                errors,
+                statistics.mean(elapsed),
+                elapsed[int(0.95 * (len(elapsed) - 1))],
+                requests.get(profile, 0),
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--packages", type=int, default=1000)
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--hosts", type=int, default=20, help="hosts per profile")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="profiles weights")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="seconds")
+    parser.add_argument("--slow", type=float, default=2.0, help="seconds")
+    parser.add_argument("--hang", type=float, default=30.0, help="seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--brute-force", type=int, default=3)
+    parser.add_argument("--cache", help="cache directory to use")
+    args = parser.parse_args()
+
+    server = MockUpstream(
+        latency=args.latency,
+        jitter=args.jitter,
+        slow=args.slow,
+        hang=args.hang,
+        error_rate=args.error_rate,
+    ).start()
+
+    config = {
+        "quiet": True,
+        "verbose": 0,
+        "format": "dict",
+        "skip-robots-txt": True,
+        "brute-force": args.brute_force,
+        "cache": args.cache or False,
+    }
+
+    packages = generate_packages(args.packages, args.mix, args.hosts)
+
+    start = time.perf_counter()
+    try:
+        if args.jobs > 1:
+            with multiprocessing.Pool(
+                args.jobs, init_worker, (server.server_address, config)
+            ) as pool:
+                stats = pool.map(scan, packages, chunksize=8)
+        else:
+            init_worker(server.server_address, config)
+            stats = [scan(package) for package in packages]
+    finally:
+        elapsed = time.perf_counter() - start
+        server.stop()
+
+    print_report(stats, elapsed, server.requests)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+# Copyright 2020-2024 src_prepare group
+# Distributed under the terms of the GNU General Public License v2
+
+"""
+Synthetic upstream server for load testing the scanning pipeline.
+
+Requests are routed by host name, the second label selects how the
+host behaves, e.g. http://h3.dir.mock/releases/pkg12/:
+
+dir        browsable directories listing versioned tarballs
+head       no directory listing, tarballs only answer HEAD (brute force)
+slow       like dir, with an additional latency
+hang       never answers before the client gives up
+ratelimit  answers 429 Too Many Requests
+broken     answers 200 for everything, even missing files
+
+Each package has versions 1.0.0 to 1.<k>.0 plus one newer version,
+see package_versions().
+"""
+
+import http.server
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+
+PROFILES = ("dir", "head", "slow", "hang", "ratelimit", "broken")
+
+_name_re = re.compile(r"pkg(\d+)")
+_tarball_re = re.compile(r"^(pkg\d+)-([\d.]+)\.tar\.gz$")
+
+
+def package_versions(name):
+    """
+    Return (current, versions) for a synthetic package
+    """
+    n = int(_name_re.match(name).group(1))
+    k = n % 5
+    current = f"1.{k}.0"
+    return current, [f"1.{i}.0" for i in range(k + 2)]
+
+
+def listing(path, versions, name):
+    rows = "".join(
+        f'<tr><td><a href="{name}-{v}.tar.gz">{name}-{v}.tar.gz</a></td></tr>\n'
+        for v in versions
+    )
+    return (
+        f"<html><head><title>Index of {path}</title></head><body>\n"
+        f"<h1>Index of {path}</h1>\n<table>\n"
+        '<tr><td><a href="../">Parent Directory</a></td></tr>\n'
+        f"{rows}</table></body></html>\n"
+    ).encode()
+
+
+class MockRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(
+        self, status, body=b"", content_type="text/html", head=False, length=None
+    ):
+        if length is None:
+            length = len(body)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(length))
+        if status == 429:
+            self.send_header("Retry-After", "60")
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def _serve(self, head=False):
+        server = self.server
+        url = urllib.parse.urlparse(urllib.parse.unquote(self.path[1:]))
+        labels = (url.hostname or "").split(".")
+        profile = labels[1] if len(labels) > 2 else "dir"
+
+        with server.lock:
+            server.requests[profile] = server.requests.get(profile, 0) + 1
+
+        delay = server.latency + random.uniform(0, server.jitter)
+        if profile == "slow":
+            delay += server.slow
+        elif profile == "hang":
+            delay += server.hang
+        if delay:
+            time.sleep(delay)
+
+        if server.error_rate and random.random() < server.error_rate:
+            return self._respond(500, b"Internal Server Error", head=head)
+
+        if profile == "ratelimit":
+            return self._respond(429, b"Too Many Requests", head=head)
+
+        if profile == "broken":
+            return self._respond(
+                200, b"\0" * 1024, "application/octet-stream", head=head
+            )
+
+        path = url.path.rstrip("/")
+        basename = path.rsplit("/", 1)[-1]
+
+        match = _tarball_re.match(basename)
+        if match:
+            name, version = match.groups()
+            if version not in package_versions(name)[1]:
+                return self._respond(404, b"Not Found", head=head)
+            # Tarballs are HEAD-only, nobody downloads them
+            if not head:
+                return self._respond(405, b"Method Not Allowed")
+            return self._respond(200, content_type="application/x-gzip", length=4096)
+
+        if profile != "head" and _name_re.fullmatch(basename):
+            versions = package_versions(basename)[1]
+            return self._respond(200, listing(url.path, versions, basename), head=head)
+
+        return self._respond(404, b"Not Found", head=head)
+
+    def do_GET(self):  # noqa: N802
+        self._serve()
+
+    def do_HEAD(self):  # noqa: N802
+        self._serve(head=True)
+
+
+class MockUpstream(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(
+        self,
+        address=("127.0.0.1", 0),
+        latency=0.0,
+        jitter=0.0,
+        slow=2.0,
+        hang=30.0,
+        error_rate=0.0,
+    ):
+        super().__init__(address, MockRequestHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.slow = slow
+        self.hang = hang
+        self.error_rate = error_rate
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        # Clients giving up on hanging or slow hosts are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
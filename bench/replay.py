@@ -0,0 +1,341 @@
+# Copyright 2020-2024 src_prepare group
+# Distributed under the terms of the GNU General Public License v2
+
+"""
+Replay recorded upstream responses from local fixture servers, over HTTP
+for every url scheme, and over FTP for ftp:// directory listings
+"""
+
+import datetime
+import ftplib
+import gzip
+import http.client
+import http.server
+import io
+import json
+import os
+import socket
+import socketserver
+import threading
+import urllib.parse
+import urllib.request
+import urllib.response
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+class Fixtures:
+    """
+    Recorded responses by url, described in fixtures.json:
+    {url: {"status": int, "headers": {...}, "body": filename,
+           "recorded": date}}
+    """
+
+    def __init__(self, directory=FIXTURES_DIR):
+        self.directory = directory
+        with open(os.path.join(directory, "fixtures.json")) as fp:
+            self.index = json.load(fp)
+        self.bodies = {}
+
+    def __contains__(self, url):
+        return url in self.index
+
+    def get(self, url):
+        fixture = self.index.get(url)
+        if fixture is None:
+            return None
+
+        if url not in self.bodies:
+            body = b""
+            if fixture.get("body"):
+                with open(os.path.join(self.directory, fixture["body"]), "rb") as fp:
+                    body = fp.read()
+            self.bodies[url] = body
+
+        return fixture.get("status", 200), fixture.get("headers", {}), self.bodies[url]
+
+    def record(self, timeout=30):
+        """
+        Refresh the recorded responses from live upstreams
+        """
+        for url, fixture in self.index.items():
+            if url.startswith("ftp://"):
+                self.record_ftp(url, fixture, timeout)
+                continue
+
+            request = urllib.request.Request(url)
+            request.add_header("User-Agent", "euscan-ng benchmarks")
+            try:
+                fp = urllib.request.urlopen(request, timeout=timeout)
+            except OSError as e:
+                print(f"{url}: {e}")
+                continue
+
+            fixture["status"] = 200
+            fixture["headers"] = {
+                key: fp.headers[key]
+                for key in ("Content-Type", "ETag", "Last-Modified", "Link")
+                if key in fp.headers
+            }
+            if fixture.get("body"):
+                with open(os.path.join(self.directory, fixture["body"]), "wb") as f:
+                    f.write(fp.read())
+            fixture["recorded"] = datetime.date.today().isoformat()
+            print(f"{url}: recorded")
+
+        with open(os.path.join(self.directory, "fixtures.json"), "w") as fp:
+            json.dump(self.index, fp, indent=2, sort_keys=True)
+            fp.write("\n")
+
+    def record_ftp(self, url, fixture, timeout):
+        """
+        Record the MLSD listing of an ftp:// directory
+        """
+        parts = urllib.parse.urlsplit(url)
+        lines = []
+        try:
+            with ftplib.FTP(parts.hostname, timeout=timeout) as session:
+                session.login()
+                session.retrlines(f"MLSD {parts.path}", lines.append)
+        except ftplib.all_errors as e:
+            print(f"{url}: {e}")
+            return
+
+        fixture["status"] = 200
+        with open(os.path.join(self.directory, fixture["body"]), "w") as fp:
+            fp.writelines(line + "\n" for line in lines)
+        fixture["recorded"] = datetime.date.today().isoformat()
+        print(f"{url}: recorded")
+
+
+class FixtureRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serve the fixture of the url found in the request path, with support
+    for conditional and range requests, and gzip content coding.
+    Unknown urls get a 404
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _serve(self, head=False):
+        url = urllib.parse.unquote(self.path[1:])
+        self.server.requests.append((self.command, url))
+
+        fixture = self.server.fixtures.get(url)
+        if fixture is None:
+            status, headers, body = 404, {}, b""
+        else:
+            status, headers, body = fixture
+
+        if status == 200:
+            etag = headers.get("ETag")
+            if etag and self.headers.get("If-None-Match") == etag:
+                status, body = 304, b""
+            elif self.headers.get("Range", "").startswith("bytes="):
+                start = int(self.headers["Range"][6:].split("-")[0])
+                if start >= len(body):
+                    status, body = 416, b""
+                else:
+                    status, body = 206, body[start:]
+
+        identity = len(body)
+        if (
+            status == 200
+            and body
+            and "Content-Encoding" not in headers
+            and "gzip" in self.headers.get("Accept-Encoding", "")
+        ):
+            body = self.server.gzipped(url, body)
+            headers = dict(headers, **{"Content-Encoding": "gzip"})
+
+        with self.server.lock:
+            self.server.bytes_identity += identity
+            self.server.bytes_sent += len(body)
+
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def do_GET(self):  # noqa: N802
+        self._serve()
+
+    def do_POST(self):  # noqa: N802
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self._serve()
+
+    def do_HEAD(self):  # noqa: N802
+        self._serve(head=True)
+
+
+class FixtureServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, fixtures, address=("127.0.0.1", 0)):
+        super().__init__(address, FixtureRequestHandler)
+        self.fixtures = fixtures
+        self.requests = []
+        self.lock = threading.Lock()
+        self.bytes_identity = 0
+        self.bytes_sent = 0
+        self._gzipped = {}
+
+    def gzipped(self, url, body):
+        if url not in self._gzipped:
+            self._gzipped[url] = gzip.compress(body, mtime=0)
+        return self._gzipped[url]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FixtureFTPRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Minimal FTP server answering MLSD and NLST with the fixture of the
+    directory, passive mode only. Clients log in as user@host, like
+    through an FTP proxy, so that the url of the fixture is known
+    """
+
+    disable_nagle_algorithm = True
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.host = None
+        self.passive = None
+        self.reply("220 Fixture server ready")
+
+        for line in self.rfile:
+            command, _, argument = line.decode("latin-1").strip().partition(" ")
+            command = command.upper()
+            if command == "USER":
+                self.host = argument.rpartition("@")[2]
+                self.reply("331 Password required")
+            elif command == "PASS":
+                self.reply("230 Logged in")
+            elif command == "TYPE":
+                self.reply("200 Type set")
+            elif command == "PASV":
+                if self.passive is not None:
+                    self.passive.close()
+                self.passive = socket.create_server(("127.0.0.1", 0))
+                port = self.passive.getsockname()[1]
+                self.reply(
+                    "227 Entering Passive Mode (127,0,0,1,%d,%d)" % divmod(port, 256)
+                )
+            elif command in ("MLSD", "NLST"):
+                self.transfer(command, argument)
+            elif command == "QUIT":
+                self.reply("221 Goodbye")
+                break
+            else:
+                self.reply("502 Command not implemented")
+
+        if self.passive is not None:
+            self.passive.close()
+
+    def transfer(self, command, path):
+        url = f"ftp://{self.host}{path.rstrip('/')}"
+        with self.server.lock:
+            self.server.requests.append((command, url))
+
+        if self.passive is None:
+            return self.reply("425 Use PASV first")
+        passive, self.passive = self.passive, None
+
+        with passive:
+            fixture = self.server.fixtures.get(url)
+            if fixture is None or fixture[0] != 200:
+                return self.reply("550 No such directory")
+
+            lines = fixture[2].decode().splitlines()
+            if command == "NLST":
+                lines = [
+                    line.partition(" ")[2]
+                    for line in lines
+                    if "type=cdir" not in line.lower()
+                    and "type=pdir" not in line.lower()
+                ]
+            body = "".join(line + "\r\n" for line in lines).encode()
+
+            self.reply("150 Opening data connection")
+            connection, _ = passive.accept()
+            with connection:
+                connection.sendall(body)
+
+        with self.server.lock:
+            self.server.bytes_sent += len(body)
+        self.reply("226 Transfer complete")
+
+
+class FixtureFTPServer(socketserver.ThreadingTCPServer):
+    """
+    FTP fixture server, logging its requests to the given list, e.g. the
+    one of the HTTP fixture server
+    """
+
+    daemon_threads = True
+
+    def __init__(self, fixtures, address=("127.0.0.1", 0), requests=None):
+        super().__init__(address, FixtureFTPRequestHandler)
+        self.fixtures = fixtures
+        self.requests = [] if requests is None else requests
+        self.lock = threading.Lock()
+        self.bytes_sent = 0
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class ReplayHandler(urllib.request.BaseHandler):
+    """
+    urllib handler sending every request, whatever its scheme, to a
+    fixture server. Responses keep the original url
+    """
+
+    # Run before the default handlers
+    handler_order = 100
+
+    def __init__(self, address):
+        self.host, self.port = address[:2]
+        self.bytes_received = 0
+
+    def default_open(self, request):
+        connection = http.client.HTTPConnection(
+            self.host, self.port, timeout=request.timeout
+        )
+        connection.request(
+            request.get_method(),
+            "/" + urllib.parse.quote(request.full_url, safe=""),
+            body=request.data,
+            headers=dict(request.header_items()),
+        )
+        response = connection.getresponse()
+        body = response.read()
+        connection.close()
+        self.bytes_received += len(body)
+
+        fp = urllib.response.addinfourl(
+            io.BytesIO(body), response.headers, request.full_url, response.status
+        )
+        fp.msg = response.reason
+        return fp
@@ -14,6 +14,18 @@ CONFIG = {
     "brute-force": 3,
     "brute-force-recursive": True,
     "brute-force-false-watermark": 50,
+    # Maximum probes per package and consecutive misses, 0 for no limit
+    "brute-force-budget": 20,
+    "brute-force-misses": 6,
+    # Seconds and requests allowed per package and per handler, 0 for no limit
+    "package-time-budget": 600,
+    "package-request-budget": 1000,
+    "handler-time-budget": 300,
+    "handler-request-budget": 500,
+    # Consecutive failures after which a host is skipped, and seconds during
+    # which it is still skipped by the next runs, 0 to disable
+    "breaker-threshold": 3,
+    "breaker-cooldown": 0,
     "scan-dir": True,
     "oneshot": True,
     "user-agent": "euscan-ng (https://gitlab.com/src_prepare/euscan-ng)",
@@ -27,6 +39,18 @@ CONFIG = {
     "ignore-pre-release-if-stable": False,
     "ebuild-uri": False,
     "handlers-exclude": [],
+    "api-tokens": {},
+    "messages": True,
+    "spill": False,
+    # Seconds during which probed urls are not probed again
+    "probe-hit-ttl": 30 * 24 * 3600,
+    "probe-miss-ttl": 3 * 24 * 3600,
+    # Seconds during which host name lookups (and failed ones) are reused
+    "dns-ttl": 300,
+    "dns-negative-ttl": 60,
+    # Seconds after which mirrors are measured again, and probes timeout
+    "mirror-stats-ttl": 24 * 3600,
+    "mirror-probe-timeout": 3,
 }
 
 config = configparser.ConfigParser()
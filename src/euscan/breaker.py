@@ -0,0 +1,118 @@
+# Copyright 2020-2024 src_prepare group
+# Distributed under the terms of the GNU General Public License v2
+
+"""
+Per-host circuit breaker: hosts failing to answer, or answering server
+errors, several times in a row are not contacted again during the run, so
+that packages pointing at a dead host don't each wait for its timeouts.
+"""
+
+import atexit
+import threading
+import time
+import urllib.error
+
+from euscan import CONFIG, cache
+
+# Consecutive failures by host:port
+_failures = {}
+
+# {host:port: timestamp until which it is skipped}, None until loaded
+_open = None
+
+# {host:port: timestamp} of the breakers opened during this run
+_opened = {}
+_dirty = False
+_lock = threading.Lock()
+
+
+class HostUnavailable(urllib.error.URLError):
+    """
+    Raised instead of sending a request to a host known to be down
+    """
+
+    def __init__(self, host):
+        super().__init__(f"{host} unavailable")
+        self.host = host
+
+
+def _load():
+    global _open
+    if _open is None:
+        now = time.time()
+        stored = cache.load_json("breaker.json") or {}
+        _open = {host: until for host, until in stored.items() if until > now}
+        atexit.register(save)
+    return _open
+
+
+def save():
+    global _dirty
+    if _dirty:
+        with _lock:
+            now = time.time()
+            stored = {
+                host: until
+                for host, until in _open.items()
+                if until != float("inf") and until > now
+            }
+            for host, opened in _opened.items():
+                stored[host] = opened + CONFIG["breaker-cooldown"]
+        cache.store_json("breaker.json", stored)
+        _dirty = False
+
+
+def reset():
+    """
+    Save and forget the state of every breaker
+    """
+    global _open
+    save()
+    atexit.unregister(save)
+    with _lock:
+        _failures.clear()
+        _opened.clear()
+        _open = None
+
+
+def is_open(host):
+    with _lock:
+        until = _load().get(host)
+    return until is not None and until > time.time()
+
+
+def check(host):
+    """
+    Raise HostUnavailable if requests to host are short-circuited
+    """
+    if is_open(host):
+        raise HostUnavailable(host)
+
+
+def success(host):
+    with _lock:
+        _failures.pop(host, None)
+
+
+def failure(host):
+    """
+    Record a connection failure, timeout, 5xx or 429 response of host,
+    returns True when it opens the breaker of host
+    """
+    global _dirty
+
+    threshold = CONFIG["breaker-threshold"]
+    if not threshold:
+        return False
+
+    opens = _load()
+    with _lock:
+        _failures[host] = _failures.get(host, 0) + 1
+        if _failures[host] < threshold or host in opens:
+            return False
+        # Skipped for the rest of the run, and the next ones for a while
+        opens[host] = float("inf")
+        _opened[host] = time.time()
+        if CONFIG["breaker-cooldown"]:
+            _dirty = True
+    return True
@@ -0,0 +1,114 @@
+# Copyright 2020-2024 src_prepare group
+# Distributed under the terms of the GNU General Public License v2
+
+"""
+Time and request budgets for packages and handlers. Requests made once a
+budget is exhausted fail right away, so that handlers give up quickly and
+keep what they found so far.
+"""
+
+import contextlib
+import threading
+import time
+import urllib.error
+
+
+class BudgetExceeded(urllib.error.URLError):
+    """
+    Raised instead of sending a request once a budget is exhausted, seen
+    by handlers as any other failed request
+    """
+
+    def __init__(self, budget):
+        super().__init__(f"{budget.name} budget exceeded")
+        self.budget = budget
+
+
+class Budget:
+    def __init__(self, name, seconds=None, requests=None):
+        self.name = name
+        self.deadline = time.monotonic() + seconds if seconds else None
+        self.requests = requests or None
+        self.spent = 0
+        self.exceeded = False
+
+    def remaining(self):
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+    def check(self):
+        if not self.exceeded:
+            remaining = self.remaining()
+            self.exceeded = (remaining is not None and remaining <= 0) or (
+                self.requests is not None and self.spent >= self.requests
+            )
+        return not self.exceeded
+
+
+# Budgets in effect in each thread, outermost first
+_local = threading.local()
+
+
+def _active():
+    if not hasattr(_local, "budgets"):
+        _local.budgets = []
+        _local.exhausted = []
+    return _local.budgets
+
+
+@contextlib.contextmanager
+def limit(name, seconds=None, requests=None):
+    """
+    Run the enclosed block within a budget of seconds and requests, on
+    top of the ones already in effect. Yields the Budget
+    """
+    budget = Budget(name, seconds, requests)
+    budgets = _active()
+    budgets.append(budget)
+    try:
+        yield budget
+    finally:
+        budgets.remove(budget)
+        if budget.exceeded:
+            _local.exhausted.append(name)
+
+
+def exhausted():
+    """
+    Return and forget the names of the budgets exhausted in this thread
+    """
+    _active()
+    names, _local.exhausted = _local.exhausted, []
+    return names
+
+
+def exceeded():
+    """
+    Whether one of the budgets in effect is exhausted
+    """
+    return not all(budget.check() for budget in _active())
+
+
+def charge():
+    """
+    Count a request against the budgets in effect, raising BudgetExceeded
+    if one of them is exhausted
+    """
+    budgets = _active()
+    for budget in budgets:
+        if not budget.check():
+            raise BudgetExceeded(budget)
+    for budget in budgets:
+        budget.spent += 1
+
+
+def timeout(value):
+    """
+    Shorten a request timeout to the time left in the budgets in effect
+    """
+    for budget in _active():
+        remaining = budget.remaining()
+        if remaining is not None:
+            value = remaining if value is None else min(value, remaining)
+    return value
@@ -0,0 +1,190 @@
+# Copyright 2020-2024 src_prepare group
+# Distributed under the terms of the GNU General Public License v2
+
+import hashlib
+import json
+import os
+import time
+
+from euscan import CONFIG
+
+# Responses fetched during this run, used when no cache directory is set
+_responses = {}
+
+# Outcomes of url probes, {url: (timestamp, found)}, loaded lazily
+_probes = None
+
+
+def reset():
+    """
+    Forget the responses and probes outcomes kept in memory
+    """
+    global _probes
+    _responses.clear()
+    _probes = None
+
+
+def cache_dir(*parts):
+    """
+    Return (and create) a directory below the configured cache directory,
+    or None when on-disk caching is disabled
+    """
+    if not CONFIG["cache"]:
+        return None
+
+    path = os.path.join(os.path.expanduser(CONFIG["cache"]), *parts)
+    try:
+        os.makedirs(path, exist_ok=True)
+    except OSError:
+        return None
+    return path
+
+
+def cache_key(string):
+    return hashlib.sha1(string.encode("utf-8")).hexdigest()
+
+
+def load_json(name, *parts):
+    directory = cache_dir(*parts)
+    if not directory:
+        return None
+
+    try:
+        with open(os.path.join(directory, name)) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def store_json(name, data, *parts):
+    directory = cache_dir(*parts)
+    if not directory:
+        return
+
+    path = os.path.join(directory, name)
+    try:
+        with open(path + ".tmp", "w") as fp:
+            json.dump(data, fp)
+        os.replace(path + ".tmp", path)
+    except OSError:
+        pass
+
+
+def load_response(url):
+    """
+    Return the (headers, body) pair stored for url, or None
+    """
+    if url in _responses:
+        return _responses[url]
+
+    directory = cache_dir("http")
+    if not directory:
+        return None
+
+    key = cache_key(url)
+    headers = load_json(key + ".json", "http")
+    if headers is None:
+        return None
+
+    try:
+        with open(os.path.join(directory, key), "rb") as fp:
+            body = fp.read()
+    except OSError:
+        return None
+
+    _responses[url] = (headers, body)
+    return headers, body
+
+
+def store_response(url, headers, body):
+    _responses[url] = (headers, body)
+
+    directory = cache_dir("http")
+    if not directory:
+        return
+
+    key = cache_key(url)
+    path = os.path.join(directory, key)
+    try:
+        with open(path + ".tmp", "wb") as fp:
+            fp.write(body)
+        os.replace(path + ".tmp", path)
+    except OSError:
+        return
+    store_json(key + ".json", headers, "http")
+
+
+def _probes_path():
+    directory = cache_dir()
+    return os.path.join(directory, "probes.jsonl") if directory else None
+
+
+def _probe_expired(entry, now):
+    timestamp, found = entry
+    ttl = CONFIG["probe-hit-ttl"] if found else CONFIG["probe-miss-ttl"]
+    return now - timestamp > ttl
+
+
+def _load_probes():
+    global _probes
+    if _probes is not None:
+        return _probes
+
+    _probes = {}
+    path = _probes_path()
+    if not path:
+        return _probes
+
+    lines = 0
+    try:
+        with open(path) as fp:
+            for line in fp:
+                lines += 1
+                try:
+                    url, timestamp, found = json.loads(line)
+                except ValueError:
+                    continue
+                _probes[url] = (timestamp, found)
+    except OSError:
+        return _probes
+
+    # The log is append-only, rewrite it once it is mostly stale entries
+    now = time.time()
+    for url in [url for url, entry in _probes.items() if _probe_expired(entry, now)]:
+        del _probes[url]
+    if lines > 2 * len(_probes) + 1000:
+        try:
+            with open(path + ".tmp", "w") as fp:
+                for url, (timestamp, found) in _probes.items():
+                    fp.write(json.dumps([url, timestamp, found]) + "\n")
+            os.replace(path + ".tmp", path)
+        except OSError:
+            pass
+
+    return _probes
+
+
+def load_probe(url):
+    """
+    Return whether url was found when recently probed, or None if it
+    wasn't probed or the outcome expired
+    """
+    entry = _load_probes().get(url)
+    if entry is None or _probe_expired(entry, time.time()):
+        return None
+    return entry[1]
+
+
+def store_probe(url, found):
+    timestamp = time.time()
+    _load_probes()[url] = (timestamp, found)
+
+    path = _probes_path()
+    if not path:
+        return
+
+    try:
+        with open(path, "a") as fp:
+            fp.write(json.dumps([url, timestamp, found]) + "\n")
+    except OSError:
+        pass
@@ -0,0 +1,114 @@
+# Copyright 2020-2024 src_prepare group
+# Distributed under the terms of the GNU General Public License v2
+
+"""
+Pooled FTP sessions, one logged-in control connection per host reused
+across directories and packages, listing directories with MLSD or NLST.
+"""
+
+import atexit
+import ftplib
+import threading
+import urllib.parse
+
+# {(host, port, user): [session, lock]}
+_sessions = {}
+_lock = threading.Lock()
+
+
+def _connect(host, port, user, password, timeout):
+    session = ftplib.FTP(timeout=timeout)
+    session.connect(host, port)
+    session.login(user, password)
+    session.mlsd_supported = True
+    return session
+
+
+def _session(url, timeout):
+    parts = urllib.parse.urlsplit(url)
+    user = urllib.parse.unquote(parts.username or "anonymous")
+    password = urllib.parse.unquote(parts.password or "")
+    key = (parts.hostname, parts.port or ftplib.FTP_PORT, user)
+
+    with _lock:
+        entry = _sessions.get(key)
+        if entry is None:
+            entry = _sessions[key] = [None, threading.Lock()]
+
+    def connect():
+        entry[0] = _connect(key[0], key[1], user, password, timeout)
+        return entry[0]
+
+    return entry, connect, urllib.parse.unquote(parts.path) or "/"
+
+
+def _mlsd_name(line):
+    """
+    Return the name of a MLSD line, or None for the directory itself
+    and its parent
+    """
+    facts, _, name = line.partition(" ")
+    for fact in facts.lower().split(";"):
+        if fact in ("type=cdir", "type=pdir"):
+            return None
+    return name
+
+
+def _list(session, path):
+    names = []
+
+    def mlsd_line(line):
+        name = _mlsd_name(line)
+        if name is not None:
+            names.append(name)
+
+    if session.mlsd_supported:
+        try:
+            session.retrlines(f"MLSD {path}", mlsd_line)
+            return names
+        except ftplib.error_perm as e:
+            # Command not implemented (500, 502), fall back to NLST
+            if not str(e).startswith("50"):
+                raise
+            session.mlsd_supported = False
+            names.clear()
+
+    def nlst_line(line):
+        names.append(line.rsplit("/", 1)[-1])
+
+    session.retrlines(f"NLST {path}", nlst_line)
+    return names
+
+
+def listing(url, timeout=None):
+    """
+    Return the names of the files in the directory at an ftp:// url.
+    The session of the host is reconnected once if it was dropped
+    """
+    entry, connect, path = _session(url, timeout)
+
+    with entry[1]:
+        session = entry[0]
+        if session is None:
+            session = connect()
+        try:
+            return _list(session, path)
+        except (EOFError, OSError, ftplib.error_temp):
+            # Idle sessions are often closed by servers
+            session.close()
+            return _list(connect(), path)
+
+
+def close():
+    with _lock:
+        for session, _ in _sessions.values():
+            if session is None:
+                continue
+            try:
+                session.quit()
+            except (EOFError, OSError, ftplib.Error):
+                session.close()
+        _sessions.clear()
+
+
+atexit.register(close)
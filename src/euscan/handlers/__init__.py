@@ -6,9 +6,7 @@ import os
 import pkgutil
 import sys
 
-from portage.xml.metadata import MetaDataXML
-
-from euscan import CONFIG, output
+from euscan import CONFIG, budget, metadata, output
 
 handlers = {"package": [], "url": [], "all": {}}
 
@@ -56,59 +54,107 @@ def find_handlers(kind, names):
     return ret
 
 
-def get_metadata(pkg):
-    metadata = {}
+def prefetch(items):
+    """
+    Let url handlers batch their upstream queries for all the given
+    (pkg, urls) items before they are scanned one by one
+    """
+    # Only the urls scan() gives to url handlers: none for packages with
+    # a package handler, and only the first one in oneshot mode
+    scanned = []
+    for pkg, urls in items:
+        if package_handlers(pkg, get_metadata(pkg, quiet=True)):
+            continue
+        pkg_urls = [url for filename in urls for url in urls[filename] if "://" in url]
+        if CONFIG["oneshot"]:
+            pkg_urls = pkg_urls[:1]
+        scanned += [(pkg, url) for url in pkg_urls]
+
+    for handler in handlers["url"]:
+        if not hasattr(handler, "prefetch"):
+            continue
+
+        handled = [
+            (pkg, url)
+            for pkg, url in scanned
+            if find_best_handler("url", pkg, url) is handler
+        ]
+        if not handled:
+            continue
+
+        try:
+            handler.prefetch(handled)
+        except Exception as e:
+            output.ewarn(f"Prefetch failed: [{e.__class__.__name__}] {str(e)}")
+
+
+def reset():
+    """
+    Let handlers forget what they fetched during this run
+    """
+    for handler in handlers["all"].values():
+        if hasattr(handler, "reset"):
+            handler.reset()
+
+
+def scanned(pkg):
+    """
+    Let url handlers forget what they prefetched for pkg once it is scanned
+    """
+    for handler in handlers["url"]:
+        if hasattr(handler, "scanned"):
+            handler.scanned(pkg)
 
-    pkg_metadata = None
 
+def get_metadata(pkg, quiet=False):
     meta_override = os.path.join("metadata", pkg.category, pkg.name, "metadata.xml")
 
     try:
-        if os.path.exists(meta_override):
-            pkg_metadata = MetaDataXML(meta_override)
-            output.einfo("Using custom metadata: %s" % meta_override)
-        if not pkg_metadata:
-            pkg_metadata = pkg.metadata
+        upstream = metadata.lookup(meta_override)
+        if upstream is not None:
+            if not quiet:
+                output.einfo("Using custom metadata: %s" % meta_override)
+            return upstream
+
+        ebuild_path = pkg.ebuild_path()
+        if ebuild_path:
+            path = os.path.join(os.path.dirname(ebuild_path), "metadata.xml")
+            return metadata.lookup(path) or {}
     except Exception as e:
-        output.ewarn("Error when fetching metadata: %s" % str(e))
-
-    if not pkg_metadata:
-        return {}
-
-    # Support multiple remote-id and multiple watch
-    for upstream in pkg_metadata._xml_tree.findall("upstream"):
-        for node in upstream.findall("watch"):
-            options = dict(node.attrib)
-            options["data"] = node.text
-
-            if "type" in options:
-                handler = options["type"]
-            else:
-                handler = "url"
-                options["type"] = "url"
-
-            for key in ["versionmangle", "downloadurlmangle"]:
-                value = options.get(key, None)
-                if value:
-                    options[key] = value.split(";")
-
-            if handler not in metadata:
-                metadata[handler] = []
-            metadata[handler].append(options)
-
-    for upstream in pkg_metadata._xml_tree.findall("upstream"):
-        for node in upstream.findall("remote-id"):
-            handler = node.attrib.get("type")
-            if not handler:
-                continue
-            if handler in metadata:
-                for i in range(len(metadata[handler])):
-                    if not metadata[handler][i]["data"]:
-                        metadata[handler][i]["data"] = node.text
-            else:
-                metadata[handler] = [{"type": handler, "data": node.text}]
+        if not quiet:
+            output.ewarn("Error when fetching metadata: %s" % str(e))
 
-    return metadata
+    return {}
+
+
+def package_handlers(pkg, upstream):
+    """
+    Return the package handlers scanning pkg, given its upstream metadata
+    """
+    pkg_handlers = find_handlers("package", list(upstream.keys()))
+    if not pkg_handlers:
+        pkg_handler = find_best_handler("package", pkg)
+        if pkg_handler:
+            pkg_handlers = [pkg_handler]
+    return pkg_handlers
+
+
+def run_handler(handler, scan, pkg, *args):
+    """
+    Call scan(pkg, *args) within the time and request budget of a handler
+    """
+    with budget.limit(
+        handler.HANDLER_NAME,
+        CONFIG["handler-time-budget"],
+        CONFIG["handler-request-budget"],
+    ) as spent:
+        versions = scan(pkg, *args)
+
+    if spent.exceeded:
+        output.ewarn(
+            f"Budget exceeded for {handler.HANDLER_NAME}, results may be incomplete"
+        )
+    return versions
 
 
 def scan_pkg(pkg_handler, pkg, options, on_progress=None):
@@ -118,7 +164,7 @@ def scan_pkg(pkg_handler, pkg, options, on_progress=None):
         on_progress(increment=35)
 
     for o in options:
-        versions += pkg_handler.scan_pkg(pkg, o)
+        versions += run_handler(pkg_handler, pkg_handler.scan_pkg, pkg, o)
 
     if on_progress:
         on_progress(increment=35)
@@ -153,7 +199,9 @@ def scan_url(pkg, urls, options, on_progress=None):
                 url_handler = find_best_handler("url", pkg, url)
                 if url_handler:
                     for o in options:
-                        versions += url_handler.scan_url(pkg, url, o)
+                        versions += run_handler(
+                            url_handler, url_handler.scan_url, pkg, url, o
+                        )
                 else:
                     output.eerror("Can't find a suitable handler!")
             except Exception as e:
@@ -178,21 +226,19 @@ def scan(pkg, urls, on_progress=None):
     if not CONFIG["quiet"] and not CONFIG["format"]:
         sys.stdout.write("\n")
 
-    metadata = get_metadata(pkg)
+    upstream = get_metadata(pkg)
     versions = []
 
-    pkg_handlers = find_handlers("package", list(metadata.keys()))
-    if not pkg_handlers:
-        pkg_handler = find_best_handler("package", pkg)
-        if pkg_handler:
-            pkg_handlers = [pkg_handler]
-
-    for pkg_handler in pkg_handlers:
-        options = metadata.get(pkg_handler.HANDLER_NAME, [{}])
-        versions += scan_pkg(pkg_handler, pkg, options, on_progress)
-
-    if not pkg_handlers:
-        versions += scan_url(pkg, urls, [{}], on_progress)
+    pkg_handlers = package_handlers(pkg, upstream)
+    try:
+        for pkg_handler in pkg_handlers:
+            options = upstream.get(pkg_handler.HANDLER_NAME, [{}])
+            versions += scan_pkg(pkg_handler, pkg, options, on_progress)
+
+        if not pkg_handlers:
+            versions += scan_url(pkg, urls, [{}], on_progress)
+    finally:
+        scanned(pkg)
 
     return versions
 
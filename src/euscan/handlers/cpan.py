@@ -2,11 +2,7 @@
 # Copyright 2020-2023 src_prepare group
 # Distributed under the terms of the GNU General Public License v2
 
-import json
 import re
-import urllib.error
-import urllib.parse
-import urllib.request
 
 import portage
 
@@ -16,7 +12,10 @@ HANDLER_NAME = "cpan"
 CONFIDENCE = 100
 PRIORITY = 90
 
+CPAN_PACKAGES_URL = "https://www.cpan.org/modules/02packages.details.txt.gz"
+
 _cpan_package_name_re = re.compile("mirror://cpan/authors/.*/([^/.]*).*")
+_cpan_dist_re = re.compile(r"^(.+)-(v?\d[^-]*?)\.(?:tar\.(?:gz|bz2|xz)|tgz|zip)$")
 
 
 def can_handle(pkg, url=None):
@@ -111,6 +110,31 @@ def scan_url(pkg, url, options):
     return scan_pkg(pkg, {"data": remote_pkg})
 
 
+def parse_packages(fp):
+    """
+    Build a {distribution: {version: path}} index from 02packages.details
+    """
+    index = {}
+    header = True
+
+    for line in helpers.iter_lines(fp, CPAN_PACKAGES_URL):
+        # Headers end with an empty line
+        if header:
+            header = bool(line.strip())
+            continue
+
+        fields = line.split()
+        if len(fields) != 3:
+            continue
+
+        path = fields[2].decode("utf-8", "replace")
+        match = _cpan_dist_re.match(path.rsplit("/", 1)[-1])
+        if match:
+            index.setdefault(match.group(1), {})[match.group(2)] = path
+
+    return index
+
+
 def scan_pkg(pkg, options):
     remote_pkg = options["data"]
 
@@ -118,35 +142,20 @@ def scan_pkg(pkg, options):
     if "versionmangle" not in options:
         options["versionmangle"] = ["cpan", "gentoo"]
 
-    url = "http://search.cpan.org/api/dist/%s" % remote_pkg
     cp, ver = pkg.cp, pkg.version
     m_ver = cpan_mangle_version(ver)
 
-    output.einfo("Using CPAN API: " + url)
+    output.einfo("Using CPAN index: " + remote_pkg)
 
-    try:
-        fp = helpers.urlopen(url)
-    except urllib.error.URLError:
-        return []
-    except OSError:
-        return []
+    index = helpers.urlopen_index(CPAN_PACKAGES_URL, parse_packages, "cpan")
 
-    if not fp:
-        return []
-
-    data = fp.read()
-    data = json.loads(data)
-
-    if "releases" not in data:
+    releases = index.get(remote_pkg)
+    if not releases:
         return []
 
     ret = []
 
-    for version in data["releases"]:
-        # if version['status'] == 'testing':
-        #    continue
-
-        up_pv = version["version"]
+    for up_pv, path in releases.items():
         pv = mangling.mangle_version(up_pv, options)
 
         if up_pv.startswith("v"):
@@ -157,7 +166,7 @@ def scan_pkg(pkg, options):
             if helpers.version_filtered(cp, m_ver, m_pv, cpan_vercmp):
                 continue
 
-        url = f"mirror://cpan/authors/id/{version['cpanid'][0]}/{version['cpanid'][0:1]}/{version['cpanid']}/{version['archive']}"
+        url = f"mirror://cpan/authors/id/{path}"
         url = mangling.mangle_url(url, options)
         ret.append((url, pv, HANDLER_NAME, CONFIDENCE))
 
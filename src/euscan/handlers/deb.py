@@ -2,13 +2,6 @@
 # Copyright 2020-2023 src_prepare group
 # Distributed under the terms of the GNU General Public License v2
 
-import bz2
-import re
-import urllib.error
-import urllib.parse
-import urllib.request
-import zlib
-
 import portage
 
 from euscan import helpers, mangling, output
@@ -22,32 +15,36 @@ def can_handle(pkg, url=None):
     return False
 
 
-def scan_pkg(pkg, options):
-    cp, ver, rev = portage.pkgsplit(pkg.cpv)
+def parse_packages(fp, packages_url):
+    """
+    Build a {package: [versions]} index from a Packages file
+    """
+    index = {}
+    package = None
 
-    packages_url, package_name = options["data"].strip().split(" ", 1)
+    for line in helpers.iter_lines(fp, packages_url):
+        if line.startswith(b"Package: "):
+            package = line[9:].strip().decode("utf-8", "replace")
+        elif line.startswith(b"Version: ") and package:
+            version = line[9:].strip().decode("utf-8", "replace")
+            index.setdefault(package, []).append(version)
+        elif not line.strip():
+            package = None
 
-    output.einfo("Using Debian Packages: " + packages_url)
+    return index
 
-    fp = urllib.request.urlopen(packages_url)
-    content = fp.read()
 
-    # Support for .gz and .bz2 Packages file
-    if packages_url.endswith(".bz2"):
-        content = bz2.decompress(content)
-    if packages_url.endswith(".gz"):
-        content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
+def scan_pkg(pkg, options):
+    cp, ver, rev = portage.pkgsplit(pkg.cpv)
 
-    content = content.split("\n\n")
+    packages_url, package_name = options["data"].strip().split(" ", 1)
 
-    result = []
+    output.einfo("Using Debian Packages: " + packages_url)
 
-    for package_info in content:
-        package_line = re.search(r"^Package: (.*)$", package_info, re.M)
-        version_line = re.search(r"^Version: (.*)$", package_info, re.M)
-        if package_line and package_line.group(1) == package_name:
-            if version_line:
-                result.append(version_line.group(1))
+    index = helpers.urlopen_index(
+        packages_url, lambda fp: parse_packages(fp, packages_url), "deb"
+    )
+    result = index.get(package_name, [])
 
     ret = []
     for up_pv in result:
@@ -2,25 +2,35 @@
 # Copyright 2020-2023 src_prepare group
 # Distributed under the terms of the GNU General Public License v2
 
+import collections
+import concurrent.futures
+import datetime
 import difflib
-import io
+import ftplib
+import html.parser
 import re
+import threading
+import time
 import urllib.error
 import urllib.parse
 import urllib.request
-import warnings
 from urllib.parse import urljoin, urlparse
 
 import portage
-from bs4 import BeautifulSoup, XMLParsedAsHTMLWarning
 
 from euscan import (
     BRUTEFORCE_BLACKLIST_PACKAGES,
     BRUTEFORCE_BLACKLIST_URLS,
     CONFIG,
     SCANDIR_BLACKLIST_URLS,
+    breaker,
+    budget,
+    cache,
+    ftp,
     helpers,
+    latency,
     mangling,
+    mirrors,
     output,
 )
 
@@ -28,10 +38,48 @@ HANDLER_NAME = "generic"
 CONFIDENCE = 45
 PRIORITY = 0
 
+# Mirrors tried for a mirror:// url before giving up
+MIRROR_ATTEMPTS = 3
+
+# Directory listings fetched at once by prefetch()
+PREFETCH_JOBS = 8
+
+# Directory listings kept for packages scanned next to each other
+LISTINGS_KEPT = 16
+
+# Links of the latest directory listings fetched, by url
+_listings = collections.OrderedDict()
+_listings_lock = threading.Lock()
+
+# Results of patterns matched by prefetch() and the packages left to be
+# scanned using them, by (url, pattern), and these keys by package
+_matches = {}
+_users = {}
+
 BRUTEFORCE_HANDLER_NAME = "brute_force"
 BRUTEFORCE_CONFIDENCE = 30
 
 
+def reset():
+    with _listings_lock:
+        _listings.clear()
+    _matches.clear()
+    _users.clear()
+
+
+def scanned(pkg):
+    """
+    Forget the results prefetched for pkg, once no other package needs them
+    """
+    for key in _users.pop(pkg.cpv, ()):
+        entry = _matches.get(key)
+        if entry is None:
+            continue
+        entry[1].discard(pkg.cpv)
+        if not entry[1]:
+            del _matches[key]
+
+
 def confidence_score(found, original, minimum=CONFIDENCE):
     found_p = urlparse(found)
     original_p = urlparse(original)
@@ -61,71 +109,189 @@ def confidence_score(found, original, minimum=CONFIDENCE):
     return int(minimum + minimum * diff)  # maximum score is minimum * 2
 
 
-def scan_html(data, url, pattern):
-    warnings.filterwarnings("ignore", category=XMLParsedAsHTMLWarning)
-    soup = BeautifulSoup(data, features="lxml")
-    results = []
+class LinkParser(html.parser.HTMLParser):
+    """
+    Collect the href of <a> elements of a page fed as it is downloaded,
+    relative to url when they start with it
+    """
+
+    def __init__(self, url):
+        super().__init__()
+        self.url = url
+        self.links = []
 
-    for link in soup.findAll("a"):
-        href = link.get("href")
+    def handle_starttag(self, tag, attrs):
+        if tag != "a":
+            return
+
+        href = next((value for name, value in attrs if name == "href"), None)
         if not href:
-            continue
+            return
 
-        if href.startswith(url):
-            href = href.replace(url, "", 1)
+        if href.startswith(self.url):
+            href = href.replace(self.url, "", 1)
 
-        match = re.search(pattern, href, re.I)
-        if match:
-            results.append(
-                (".".join([x for x in match.groups() if x is not None]), match.group(0))
-            )
+        self.links.append(href)
 
-    return results
 
+def parse_html_links(data, url):
+    if isinstance(data, bytes):
+        data = data.decode("utf-8", "replace")
 
-def scan_ftp(data, url, pattern):
-    buf = io.StringIO(data)
+    parser = LinkParser(url)
+    parser.feed(data)
+    parser.close()
+    return parser.links
+
+
+def parse_ftp_lines(data):
+    """
+    Return the file names of a LIST or NLST directory listing
+    """
+    if isinstance(data, bytes):
+        data = data.decode("utf-8", "replace")
+
+    names = []
+    for line in data.splitlines():
+        # Unix LIST lines: permissions links owner group size month day time name
+        fields = line.split(None, 8)
+        if len(fields) == 9 and fields[0][:1] in "-dlbcps" and fields[4].isdigit():
+            line = fields[8].split(" -> ", 1)[0]
+        names.append(line)
+    return names
+
+
+def _version_match(match):
+    return (".".join([x for x in match.groups() if x is not None]), match.group(0))
+
+
+def match_links(links, pattern):
+    regex = helpers.compile_pattern(pattern, re.I)
     results = []
 
-    for line in buf.readlines():
-        line = line.replace("\n", "").replace("\r", "")
-        match = re.search(pattern, line, re.I)
+    for link in links:
+        match = regex.search(link)
         if match:
-            results.append(
-                (".".join([x for x in match.groups() if x is not None]), match.group(0))
-            )
+            results.append(_version_match(match))
+
     return results
 
 
-def scan_directory_recursive(cp, ver, rev, url, steps, orig_url, options):
-    if not steps:
-        return []
+def scan_html(data, url, pattern):
+    return match_links(parse_html_links(data, url), pattern)
 
-    url += steps[0][0]
-    pattern = steps[0][1]
 
-    steps = steps[1:]
+def scan_ftp(data, url, pattern):
+    return match_links(parse_ftp_lines(data), pattern)
 
-    output.einfo("Scanning: %s" % url)
+
+def fetch_ftp_listing(url):
+    """
+    Return the file names of the ftp:// directory at url, or None, using
+    the pooled session of its host instead of a new login per directory
+    """
+    host = latency.host_of(url)
+    if breaker.is_open(host):
+        mirrors.record_url(url)
+        return None
+
+    mirrors.fetching(url)
+    try:
+        budget.charge()
+    except budget.BudgetExceeded:
+        return None
+
+    start = time.monotonic()
+    try:
+        links = ftp.listing(url, budget.timeout(helpers.timeout_for_url(url)))
+    except ftplib.error_perm:
+        # Missing directories, the server itself is fine
+        mirrors.record_url(url, time.monotonic() - start)
+        breaker.success(host)
+        return None
+    except (EOFError, OSError):
+        mirrors.record_url(url)
+        if breaker.failure(host):
+            output.ewarn(f"{host} is unavailable, skipping it from now on")
+        return None
+    except ftplib.all_errors:
+        mirrors.record_url(url)
+        return None
+    mirrors.record_url(url, time.monotonic() - start)
+    breaker.success(host)
+    return links
+
+
+def _keep_listing(url, links):
+    with _listings_lock:
+        _listings[url] = links
+        while len(_listings) > LISTINGS_KEPT:
+            _listings.popitem(last=False)
+
+
+def fetch_listing(url):
+    """
+    Return the links of the directory listing at url, or None if it
+    can't be fetched. The latest listings are kept, failures are retried
+    so that mirror failover notices them
+    """
+    with _listings_lock:
+        if url in _listings:
+            _listings.move_to_end(url)
+            return _listings[url]
+
+    if url.startswith("ftp://"):
+        links = fetch_ftp_listing(url)
+        if links is not None:
+            _keep_listing(url, links)
+        return links
 
     try:
         fp = helpers.urlopen(url)
     except urllib.error.URLError:
-        return []
+        fp = None
     except OSError:
-        return []
+        fp = None
 
     if not fp:
+        return None
+
+    # Parsed while downloaded, without keeping the whole page
+    parser = LinkParser(url)
+    for text in helpers.iter_text(fp):
+        parser.feed(text)
+    parser.close()
+    links = parser.links
+
+    _keep_listing(url, links)
+    return links
+
+
+def _prefetched(url, pattern):
+    """
+    Return the results of pattern prefetched for url, or None
+    """
+    entry = _matches.get((url, pattern))
+    return entry[0] if entry is not None else None
+
+
+def scan_directory_recursive(cp, ver, rev, url, steps, orig_url, options):
+    if not steps or budget.exceeded():
         return []
 
-    data = fp.read()
+    url += steps[0][0]
+    pattern = steps[0][1]
 
-    results = []
+    steps = steps[1:]
 
-    if re.search(rb"<\s*a\s+[^>]*href", data, re.I):
-        results.extend(scan_html(data, url, pattern))
-    elif url.startswith("ftp://"):
-        results.extend(scan_ftp(data, url, pattern))
+    output.einfo("Scanning: %s" % url)
+
+    results = _prefetched(url, pattern)
+    if results is None:
+        links = fetch_listing(url)
+        if links is None:
+            return []
+        results = match_links(links, pattern)
 
     versions = []
 
@@ -150,39 +316,100 @@ def scan_directory_recursive(cp, ver, rev, url, steps, orig_url, options):
     return versions
 
 
+def url_template(pkg, resolved_url):
+    """
+    Return (ver, template) for a resolved url
+    """
+    cp, ver, rev = portage.pkgsplit(pkg.cpv)
+
+    # 'Hack' for _beta/_rc versions where _ is used instead of -
+    if ver not in resolved_url:
+        newver = helpers.version_change_end_sep(ver)
+        if newver and newver in resolved_url:
+            output.einfo(f"Version: using {newver} instead of {ver}")
+            ver = newver
+
+    return ver, helpers.parse_template(resolved_url, ver)
+
+
+def prefetch(items):
+    """
+    Fetch the first directory listing of all given urls, each listing
+    only once, and match the patterns of all packages sharing a listing
+    in a single pass over its links
+    """
+    if not CONFIG["scan-dir"]:
+        return
+
+    groups = {}
+    for pkg, url in items:
+        if any(re.match(bu, url) for bu in SCANDIR_BLACKLIST_URLS):
+            continue
+
+        resolved_url = helpers.parse_mirror(url)
+        if not resolved_url:
+            continue
+
+        _ver, template = url_template(pkg, resolved_url)
+        if not template.depends_on_version():
+            continue
+
+        if template.steps:
+            listing_url, pattern = template.steps[0]
+            patterns = groups.setdefault(listing_url, {})
+            patterns.setdefault(pattern, set()).add(pkg.cpv)
+
+    # Listings shared by several packages are the point of prefetching,
+    # others are fetched when scanned
+    shared = [
+        url
+        for url, patterns in groups.items()
+        if len(set().union(*patterns.values())) > 1
+    ]
+    if not shared:
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(PREFETCH_JOBS) as executor:
+        listings = dict(zip(shared, executor.map(fetch_listing, shared)))
+
+    for url, links in listings.items():
+        if not links:
+            continue
+        regexes = [
+            (pattern, helpers.compile_pattern(pattern, re.I)) for pattern in groups[url]
+        ]
+        matches = {pattern: [] for pattern in groups[url]}
+        for link in links:
+            for pattern, regex in regexes:
+                match = regex.search(link)
+                if match:
+                    matches[pattern].append(_version_match(match))
+        for pattern, results in matches.items():
+            _matches[(url, pattern)] = [results, groups[url][pattern]]
+            for cpv in groups[url][pattern]:
+                _users.setdefault(cpv, []).append((url, pattern))
+
+
 def scan_url(pkg, url, options):
+    ret = []
+
     if CONFIG["scan-dir"]:
         for bu in SCANDIR_BLACKLIST_URLS:
             if re.match(bu, url):
                 output.einfo(f"{url} is blacklisted by rule {bu}")
                 return []
 
-        resolved_url = helpers.parse_mirror(url)
-        if not resolved_url:
-            return []
-
-        cp, ver, rev = portage.pkgsplit(pkg.cpv)
-
-        # 'Hack' for _beta/_rc versions where _ is used instead of -
-        if ver not in resolved_url:
-            newver = helpers.version_change_end_sep(ver)
-            if newver and newver in resolved_url:
-                output.einfo(f"Version: using {newver} instead of {ver}")
-                ver = newver
-
-        template = helpers.template_from_url(resolved_url, ver)
-        if "${" not in template:
-            output.einfo(
-                "Url doesn't seems to depend on version: {} not found in {}".format(
-                    ver, resolved_url
-                )
-            )
+        resolved_urls = helpers.parse_mirrors(url)
+        if not resolved_urls:
             return []
-        else:
-            output.einfo("Scanning: %s" % template)
 
-        steps = helpers.generate_scan_paths(template)
-        ret = scan_directory_recursive(cp, ver, rev, "", steps, url, options)
+        # Fail over to the next mirrors when requests to one fail
+        for resolved_url in resolved_urls[:MIRROR_ATTEMPTS]:
+            failures = mirrors.failures(resolved_url)
+            ret = scan_resolved_url(pkg, url, resolved_url, options)
+            if ret or mirrors.failures(resolved_url) == failures:
+                break
+            output.einfo("Mirror failed, trying another one")
 
     if not ret:
         ret = brute_force(pkg, url)
@@ -190,6 +417,23 @@ def scan_url(pkg, url, options):
     return ret
 
 
+def scan_resolved_url(pkg, url, resolved_url, options):
+    cp, _ver, rev = portage.pkgsplit(pkg.cpv)
+    ver, template = url_template(pkg, resolved_url)
+
+    if not template.depends_on_version():
+        output.einfo(
+            "Url doesn't seems to depend on version: {} not found in {}".format(
+                ver, resolved_url
+            )
+        )
+        return []
+    else:
+        output.einfo("Scanning: %s" % template)
+
+    return scan_directory_recursive(cp, ver, rev, "", template.steps, url, options)
+
+
 def brute_force(pkg, url):
     if CONFIG["brute-force"] == 0:
         return []
@@ -213,20 +457,48 @@ def brute_force(pkg, url):
     output.einfo("Generating version from " + ver)
 
     components = helpers.split_version(ver)
-    versions = helpers.gen_versions(components, CONFIG["brute-force"])
+    versions = helpers.gen_versions(list(components), CONFIG["brute-force"])
+    calendar = helpers.is_calendar_version(components)
+    # Candidates keep the zero padding of the current version, 2024.05 -> 2024.06
+    widths = helpers.version_widths(ver)
+    year = datetime.date.today().year
+    monthly = calendar and 1 <= components[1] <= 12
+
+    def plausible(v):
+        return not calendar or (v[0] <= year and (not monthly or 1 <= v[1] <= 12))
+
+    current = list(components)
+
+    def join(v):
+        if calendar:
+            return helpers.join_version(v, widths)
+        # Only up to the first bumped component otherwise, 1.08 -> 1.09 but 2.0
+        bumped = next(
+            (n for n in range(min(len(v), len(current))) if v[n] != current[n]),
+            len(v),
+        )
+        return helpers.join_version(v, widths[: bumped + 1])
+
+    if calendar:
+        versions = [v for v in versions if plausible(v)]
+        versions += helpers.gen_calendar_versions(components)
+        # Two digits months are zero padded too, 2023.12 -> 2024.01
+        if monthly and components[1] >= 10:
+            widths[1] = 2
 
     # Remove unwanted versions
-    for v in versions:
-        if helpers.vercmp(cp, ver, helpers.join_version(v)) >= 0:
-            versions.remove(v)
+    versions = [v for v in versions if helpers.vercmp(cp, ver, join(v)) < 0]
 
     if not versions:
         output.einfo("Can't generate new versions from " + ver)
         return []
 
-    template = helpers.template_from_url(url, ver)
+    history = helpers.package_versions(cp) + [ver]
+    versions = helpers.rank_versions(components, versions, history)
+
+    template = helpers.parse_template(url, ver)
 
-    if "${PV}" not in template:
+    if not template.depends_on_version(full=True):
         output.einfo(
             f"Url doesn't seems to depend on full version: {ver} not found in {url}"
         )
@@ -237,36 +509,79 @@ def brute_force(pkg, url):
     result = []
 
     i = 0
-    done = []
+    done = set()
+    probes = 0
+    misses = 0
+
+    watermark = CONFIG["brute-force-false-watermark"]
+    budget_watermark = max(1, CONFIG["brute-force-budget"] - 1)
+    if CONFIG["brute-force-budget"] and watermark > budget_watermark:
+        # A server answering every probe never goes past the budget
+        output.einfo(
+            f"Lowering brute-force-false-watermark to {budget_watermark}"
+            f" within brute-force-budget"
+        )
+        watermark = budget_watermark
 
     while i < len(versions):
         components = versions[i]
         i += 1
-        if components in done:
+        if tuple(components) in done:
             continue
-        done.append(tuple(components))
+        done.add(tuple(components))
 
-        version = helpers.join_version(components)
+        version = join(components)
 
         if helpers.version_filtered(cp, ver, version):
             continue
 
-        try_url = helpers.url_from_template(template, version)
-        infos = helpers.tryurl(try_url, template)
+        if CONFIG["brute-force-budget"] and probes >= CONFIG["brute-force-budget"]:
+            output.einfo("Brute force budget exhausted, stopping.")
+            break
+
+        if budget.exceeded():
+            break
+
+        try_url = template.format(version)
+        # Only probes actually sent count, not the ones remembered from
+        # previous runs or skipped because of robots.txt or a dead host
+        if (
+            cache.load_probe(try_url) is None
+            and helpers.urlallowed(try_url)
+            and not breaker.is_open(latency.host_of(try_url))
+        ):
+            probes += 1
+        infos = helpers.tryurl(try_url, template.template)
+
+        if not infos and breaker.is_open(latency.host_of(try_url)):
+            output.einfo("Host unavailable, stopping.")
+            break
 
         if not infos:
+            misses += 1
+            if CONFIG["brute-force-misses"] and misses >= CONFIG["brute-force-misses"]:
+                output.einfo("Too many consecutive misses, stopping.")
+                break
             continue
+        misses = 0
+
         confidence = confidence_score(try_url, url, minimum=BRUTEFORCE_CONFIDENCE)
         result.append([try_url, version, BRUTEFORCE_HANDLER_NAME, confidence])
 
-        if len(result) > CONFIG["brute-force-false-watermark"]:
+        if len(result) > watermark:
             output.einfo("Broken server detected ! Skipping brute force.")
             return []
 
         if CONFIG["brute-force-recursive"]:
-            for v in helpers.gen_versions(list(components), CONFIG["brute-force"]):
-                if v not in versions and tuple(v) not in done:
-                    versions.append(v)
+            new_versions = [
+                v
+                for v in helpers.gen_versions(list(components), CONFIG["brute-force"])
+                if v not in versions and tuple(v) not in done and plausible(v)
+            ]
+            # Versions following the one found come first
+            versions[i:] = (
+                helpers.rank_versions(components, new_versions, history) + versions[i:]
+            )
 
         if CONFIG["oneshot"]:
             break
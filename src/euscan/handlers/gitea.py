@@ -1,7 +1,6 @@
 # Copyright 2020-2024 src_prepare group
 # Distributed under the terms of the GNU General Public License v2
 
-import json
 import re
 
 import portage
@@ -12,6 +11,9 @@ HANDLER_NAME = "gitea"
 CONFIDENCE = 100
 PRIORITY = 90
 
+# Gitea caps the page size to MAX_RESPONSE_ITEMS (50 by default)
+PER_PAGE = 50
+
 # Forgejo strives to be compatible with Gitea API
 # https://forgejo.org/2024-02-forking-forward/
 
@@ -48,23 +50,32 @@ def scan_url(pkg, url, options):
 
     output.einfo(f"Using Gitea API in {domain}: {repository}")
 
-    request = helpers.urlopen(f"https://{domain}/api/v1/repos/{repository}/releases")
-
-    data = json.load(request)
+    headers = {}
+    token = helpers.api_token(domain)
+    if token:
+        headers["Authorization"] = f"token {token}"
 
-    versions = [release["tag_name"] for release in data]
+    pages = helpers.json_pages(
+        f"https://{domain}/api/v1/repos/{repository}/releases?limit={PER_PAGE}",
+        headers,
+    )
 
     cp, ver, rev = portage.pkgsplit(pkg.cpv)
 
     ret = []
-    for up_pv in versions:
-        pv = mangling.mangle_version(up_pv, options)
-        if helpers.version_filtered(cp, ver, pv):
-            continue
-        urls = " ".join(
-            mangling.mangle_url(release["tarball_url"], options)
-            for release in data
-            if release["tag_name"] == up_pv
-        )
-        ret.append((urls, pv, HANDLER_NAME, CONFIDENCE))
+    # Releases are sorted newest first, stop paging when a whole page
+    # doesn't contain anything newer than the current version
+    for releases in pages:
+        newer = False
+        for release in releases:
+            up_pv = release["tag_name"]
+            pv = mangling.mangle_version(up_pv, options)
+            if helpers.vercmp(cp, ver, pv) < 0:
+                newer = True
+            if helpers.version_filtered(cp, ver, pv):
+                continue
+            url = mangling.mangle_url(release["tarball_url"], options)
+            ret.append((url, pv, HANDLER_NAME, CONFIDENCE))
+        if not newer:
+            break
     return ret
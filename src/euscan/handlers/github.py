@@ -0,0 +1,194 @@
+# Copyright 2020-2024 src_prepare group
+# Distributed under the terms of the GNU General Public License v2
+
+import itertools
+import json
+import re
+import urllib.error
+
+import portage
+
+from euscan import helpers, mangling, output
+
+HANDLER_NAME = "github"
+CONFIDENCE = 100
+PRIORITY = 90
+
+GITHUB_API = "https://api.github.com"
+
+# Number of repositories queried by a single GraphQL request
+BATCH_SIZE = 50
+
+# Pages of 100 tags fetched from the REST API, which lists tags by name
+# and not by date, for repositories with thousands of tags
+REST_PAGES = 5
+
+github_pattern = re.compile(
+    r"https://github\.com/(?P<owner>[^/]+)/(?P<repository>[^/]+)"
+    r"/(?:archive|releases/download)/"
+)
+
+# Tags of already queried repositories, by (owner, repository)
+_tags = {}
+
+
+def reset():
+    _tags.clear()
+
+
+def can_handle(pkg, url=None):
+    return url and github_pattern.search(url) is not None
+
+
+def guess_repository(url):
+    match = github_pattern.search(url)
+    return match.group("owner"), match.group("repository")
+
+
+def _graphql_query(repositories):
+    fields = []
+    for i, (owner, repository) in enumerate(repositories):
+        fields.append(
+            f"r{i}: repository(owner: {json.dumps(owner)}, "
+            f"name: {json.dumps(repository)}) {{ "
+            'refs(refPrefix: "refs/tags/", first: 100, '
+            "orderBy: {field: TAG_COMMIT_DATE, direction: DESC}) "
+            "{ nodes { name } } }"
+        )
+    return "query { %s }" % " ".join(fields)
+
+
+def query_graphql(repositories, token):
+    """
+    https://docs.github.com/en/graphql/reference/objects#repository
+
+    Returns the repositories whose tags couldn't be queried, all of them
+    when the request failed or was rate limited
+    """
+
+    query = json.dumps({"query": _graphql_query(repositories)})
+
+    try:
+        fp = helpers.urlopen(
+            f"{GITHUB_API}/graphql",
+            verb="POST",
+            headers={
+                "Authorization": f"bearer {token}",
+                "Content-Type": "application/json",
+            },
+            data=query.encode("utf-8"),
+        )
+    except urllib.error.URLError:
+        return repositories
+    except OSError:
+        return repositories
+
+    if not fp:
+        return repositories
+
+    try:
+        response = json.loads(fp.read())
+    except ValueError:
+        return repositories
+
+    data = response.get("data") or {}
+    errors = response.get("errors")
+
+    failed = []
+    for i, repository in enumerate(repositories):
+        node = data.get(f"r{i}")
+        if node:
+            _tags[repository] = [ref["name"] for ref in node["refs"]["nodes"]]
+        elif errors:
+            failed.append(repository)
+        else:
+            _tags[repository] = []
+    return failed
+
+
+def query_rest(repository, token=None):
+    "https://docs.github.com/en/rest/repos/repos#list-repository-tags"
+
+    owner, name = repository
+    headers = {"Authorization": f"bearer {token}"} if token else None
+    pages = helpers.json_pages(
+        f"{GITHUB_API}/repos/{owner}/{name}/tags?per_page=100", headers
+    )
+    tags = []
+    for page in itertools.islice(pages, REST_PAGES):
+        tags += [tag["name"] for tag in page]
+    _tags[repository] = tags
+
+
+def prefetch(items):
+    """
+    Query the tags of all given repositories, BATCH_SIZE at a time
+    """
+    token = helpers.api_token("github.com")
+    if not token:
+        return
+
+    repositories = []
+    for _pkg, url in items:
+        repository = guess_repository(url)
+        if repository not in _tags and repository not in repositories:
+            repositories.append(repository)
+
+    for i in range(0, len(repositories), BATCH_SIZE):
+        failed = query_graphql(repositories[i : i + BATCH_SIZE], token)
+        # Fall back to the REST API for the repositories of a failed batch
+        for repository in failed:
+            query_rest(repository, token)
+
+
+def get_tags(repository):
+    if repository not in _tags:
+        token = helpers.api_token("github.com")
+        if not token or query_graphql([repository], token):
+            query_rest(repository, token)
+    return _tags.get(repository, [])
+
+
+def tag_version(tag, names):
+    """
+    Return the version of a tag, without the "v" or "release-" prefix
+    or the name of the package or repository it may start with
+
+    >>> tag_version("gtk2-2.24.33", ["gtk2"])
+    '2.24.33'
+    >>> tag_version("v1.0", ["foo"])
+    '1.0'
+    """
+    names = "|".join(re.escape(name) for name in names)
+    return re.sub(
+        rf"^(?:(?:{names})[-_.]?)?(?:release|version)?[-_]?v?(?=\d)",
+        "",
+        tag,
+        flags=re.I,
+    )
+
+
+def scan_url(pkg, url, options):
+    owner, repository = guess_repository(url)
+
+    output.einfo(f"Using GitHub API: {owner}/{repository}")
+
+    cp, ver, rev = portage.pkgsplit(pkg.cpv)
+    # Tags may be prefixed by the package or repository name (e.g.: foo-1.0)
+    names = {cp.split("/")[1], repository}
+
+    template = helpers.parse_template(url, ver)
+
+    ret = []
+    for tag in get_tags((owner, repository)):
+        up_pv = tag_version(tag, names)
+        pv = mangling.mangle_version(up_pv, options)
+        if helpers.version_filtered(cp, ver, pv):
+            continue
+        if template.depends_on_version(full=True):
+            new_url = template.format(up_pv)
+        else:
+            new_url = f"https://github.com/{owner}/{repository}/archive/{tag}.tar.gz"
+        new_url = mangling.mangle_url(new_url, options)
+        ret.append((new_url, pv, HANDLER_NAME, CONFIDENCE))
+    return ret
@@ -1,7 +1,6 @@
 # Copyright 2020-2024 src_prepare group
 # Distributed under the terms of the GNU General Public License v2
 
-import json
 import re
 
 import portage
@@ -12,6 +11,8 @@ HANDLER_NAME = "gitlab"
 CONFIDENCE = 100
 PRIORITY = 90
 
+PER_PAGE = 100
+
 _gitlab_instances = [
     "gitlab.com",
     "gitlab.freedesktop.org",
@@ -51,32 +52,38 @@ def scan_url(pkg, url, options):
 
     output.einfo(f"Using GitLab REST API in {domain}: {repository}")
 
-    request = helpers.urlopen(
-        f"https://{domain}/api/v4/projects/{repository.replace('/', '%2F')}/releases"
-    )
-
-    data = json.load(request)
+    headers = {}
+    token = helpers.api_token(domain)
+    if token:
+        headers["PRIVATE-TOKEN"] = token
 
-    versions = [release["tag_name"] for release in data]
+    pages = helpers.json_pages(
+        f"https://{domain}/api/v4/projects/{repository.replace('/', '%2F')}"
+        f"/releases?per_page={PER_PAGE}",
+        headers,
+    )
 
     cp, ver, rev = portage.pkgsplit(pkg.cpv)
 
     ret = []
-    for up_pv in versions:
-        pv = mangling.mangle_version(up_pv, options)
-        if helpers.version_filtered(cp, ver, pv):
-            continue
-        urls = " ".join(
-            [
+    # Releases are sorted newest first, stop paging when a whole page
+    # doesn't contain anything newer than the current version
+    for releases in pages:
+        newer = False
+        for release in releases:
+            up_pv = release["tag_name"]
+            pv = mangling.mangle_version(up_pv, options)
+            if helpers.vercmp(cp, ver, pv) < 0:
+                newer = True
+            if helpers.version_filtered(cp, ver, pv):
+                continue
+            urls = " ".join(
                 mangling.mangle_url(source["url"], options)
-                for source in [
-                    release["assets"]["sources"]
-                    for release in data
-                    if release["tag_name"] == up_pv
-                ][0]
+                for source in release["assets"]["sources"]
                 # prefer tar.bz2
                 if source["format"] == "tar.bz2"
-            ]
-        )
-        ret.append((urls, pv, HANDLER_NAME, CONFIDENCE))
+            )
+            ret.append((urls, pv, HANDLER_NAME, CONFIDENCE))
+        if not newer:
+            break
     return ret
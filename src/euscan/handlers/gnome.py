@@ -2,15 +2,9 @@
 # Copyright 2020-2023 src_prepare group
 # Distributed under the terms of the GNU General Public License v2
 
+import bisect
+import functools
 import re
-import urllib.error
-import urllib.parse
-import urllib.request
-
-try:
-    import simplejson as json
-except ImportError:
-    import json
 
 import portage
 
@@ -22,6 +16,16 @@ PRIORITY = 90
 
 GNOME_URL_SOURCE = "https://download.gnome.org/sources"
 
+_version_key = functools.cmp_to_key(helpers.simple_vercmp)
+
+# Versions sorted with the comparison of a package and their keys, by
+# (url, cp), along with the version list of the index they were built from
+_sorted = {}
+
+
+def reset():
+    _sorted.clear()
+
 
 def can_handle(_pkg, url=None):
     return url and url.startswith("mirror://gnome/")
@@ -46,36 +50,66 @@ def scan_url(pkg, url, options):
     return scan_pkg(pkg, package)
 
 
+def parse_cache(fp, package):
+    """
+    Keep the files of each release and the versions sorted from
+    oldest to newest from a cache.json file
+    """
+    # [format, {package: {version: files}}, {package: [versions]}, ...]
+    items = helpers.iter_json_array(fp)
+
+    if next(items, None) != 4:
+        output.eerror("Unknow cache format detected")
+        return {}
+
+    files = next(items, {})
+    versions = sorted(next(items, {}).get(package) or [], key=_version_key)
+
+    return {
+        "versions": versions,
+        "files": {version: files[package][version] for version in versions},
+    }
+
+
+def sorted_versions(url, cp, versions):
+    """
+    Return the versions and their keys, sorted with the comparison used to
+    filter the versions of cp. Only built once per index
+    """
+    entry = _sorted.get((url, cp))
+    if entry is None or entry[0] is not versions:
+        key = functools.cmp_to_key(lambda a, b: helpers.vercmp(cp, a, b))
+        keys = sorted(key(version) for version in versions)
+        entry = _sorted[(url, cp)] = (versions, [k.obj for k in keys], keys, key)
+    return entry[1:]
+
+
 def scan_pkg(pkg, options):
     package = options["data"]
 
     output.einfo("Using Gnome json cache: " + package)
 
-    fp = urllib.request.urlopen("/".join([GNOME_URL_SOURCE, package, "cache.json"]))
-    content = fp.read()
-    fp.close()
-
-    cache = json.loads(content)
+    url = "/".join([GNOME_URL_SOURCE, package, "cache.json"])
+    cache = helpers.urlopen_index(url, lambda fp: parse_cache(fp, package), "gnome")
 
-    if cache[0] != 4:
-        output.eerror("Unknow cache format detected")
-        return []
-
-    versions = cache[2][package]
+    versions = cache.get("versions")
 
     if not versions:
         return []
 
-    versions.reverse()
-
     cp, ver, _rev = portage.pkgsplit(pkg.cpv)
 
+    # Only look at versions newer than the current one, newest first.
+    # bisect only takes a key function since Python 3.10
+    versions, keys, key = sorted_versions(url, cp, versions)
+    start = bisect.bisect_right(keys, key(ver))
+
     ret = []
-    for up_pv in versions:
+    for up_pv in reversed(versions[start:]):
         pv = mangling.mangle_version(up_pv, options)
         if helpers.version_filtered(cp, ver, pv):
             continue
-        up_files = cache[1][package][up_pv]
+        up_files = cache["files"][up_pv]
         for tarball_comp in ("tar.xz", "tar.bz2", "tar.gz"):
             if tarball_comp in up_files:
                 url = "/".join([GNOME_URL_SOURCE, package, up_files[tarball_comp]])
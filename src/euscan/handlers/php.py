@@ -3,10 +3,7 @@
 # Distributed under the terms of the GNU General Public License v2
 
 import re
-import urllib.error
-import urllib.parse
-import urllib.request
-import xml.dom.minidom
+from xml.etree import ElementTree
 
 from euscan import helpers, mangling, output
 
@@ -36,35 +33,56 @@ def scan_url(pkg, url, options):
     return scan_pkg(pkg, {"type": channel, "data": package})
 
 
+def _local_name(element):
+    return element.tag.rsplit("}", 1)[-1]
+
+
+def parse_packages(fp):
+    """
+    Build a {lowercase name: name} index of the packages of a channel
+    """
+    packages = {}
+    for _event, element in ElementTree.iterparse(fp):
+        if _local_name(element) == "p" and element.text:
+            packages[element.text.lower()] = element.text
+        element.clear()
+    return packages
+
+
+def parse_releases(fp):
+    versions = []
+    for _event, element in ElementTree.iterparse(fp):
+        if _local_name(element) == "v" and element.text:
+            versions.append(element.text)
+        element.clear()
+    return {"versions": versions}
+
+
 def scan_pkg(pkg, options):
     cp, ver = pkg.cp, pkg.version
 
     package = options["data"]
     channel = options["type"]
 
-    url = f"http://{channel}.php.net/rest/r/{package.lower()}/allreleases.xml"
+    rest_url = f"http://{channel}.php.net/rest"
 
-    output.einfo("Using: " + url)
-
-    try:
-        fp = helpers.urlopen(url)
-    except urllib.error.URLError:
-        return []
-    except OSError:
+    # The channel packages list is shared by all the packages of the run
+    packages = helpers.urlopen_index(
+        f"{rest_url}/p/packages.xml", parse_packages, "php"
+    )
+    if packages and package.lower() not in packages:
+        output.einfo(f"{package} not found in {channel} channel")
         return []
 
-    if not fp:
-        return []
+    url = f"{rest_url}/r/{package.lower()}/allreleases.xml"
 
-    data = fp.read()
+    output.einfo("Using: " + url)
 
-    dom = xml.dom.minidom.parseString(data)
+    releases = helpers.urlopen_index(url, parse_releases, "php")
 
-    nodes = dom.getElementsByTagName("v")
     ret = []
 
-    for node in nodes:
-        up_pv = node.childNodes[0].data
+    for up_pv in releases.get("versions", []):
         pv = mangling.mangle_version(up_pv, options)
         if helpers.version_filtered(cp, ver, pv):
             continue
@@ -2,20 +2,30 @@
 # Copyright 2020-2024 src_prepare group
 # Distributed under the terms of the GNU General Public License v2
 
-import json
+import http.client
+import os
 import re
+import shutil
 import urllib.error
-import urllib.parse
-import urllib.request
 
 import portage
 
-from euscan import helpers, mangling, output
+from euscan import cache, helpers, mangling, output
 
 HANDLER_NAME = "rubygems"
 CONFIDENCE = 100
 PRIORITY = 90
 
+RUBYGEMS_URL = "https://rubygems.org"
+
+# Compact index versions fields, by gem, loaded once per run
+_versions = None
+
+
+def reset():
+    global _versions
+    _versions = None
+
 
 def can_handle(pkg, url=None):
     return url and url.startswith("https://rubygems.org/")
@@ -50,28 +60,130 @@ def scan_url(pkg, url, options):
     return scan_pkg(pkg, {"data": gem})
 
 
-def scan_pkg(pkg, options):
-    gem = options["data"]
-    url = "http://rubygems.org/api/v1/versions/%s.json" % gem
+def update_versions_file(path):
+    """
+    Download the compact index versions file, when it is already in the
+    cache directory only the lines appended since last run are fetched
+    """
+    url = f"{RUBYGEMS_URL}/versions"
+
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+
+    headers = {}
+    if size:
+        # Fetch the last known byte too, to check the file was only appended
+        headers["Range"] = f"bytes={size - 1}-"
 
     try:
-        fp = helpers.urlopen(url)
+        fp = helpers.urlopen(url, headers=headers)
+    except urllib.error.HTTPError as e:
+        if e.code == 416 and size:
+            os.unlink(path)
+            return update_versions_file(path)
+        return
     except urllib.error.URLError:
-        return []
+        return
     except OSError:
-        return []
+        return
 
     if not fp:
-        return []
+        return
 
-    data = fp.read()
-    versions = json.loads(data)
+    # Written while downloaded, the full file is tens of megabytes
+    try:
+        if fp.status == 206:
+            if fp.read(1) != b"\n":
+                os.unlink(path)
+                return update_versions_file(path)
+            with open(path, "ab") as f:
+                shutil.copyfileobj(fp, f)
+        else:
+            with open(path + ".tmp", "wb") as f:
+                shutil.copyfileobj(fp, f)
+            os.replace(path + ".tmp", path)
+    except (OSError, EOFError, http.client.HTTPException):
+        # Timeouts and dropped connections, keep the cached file as it was
+        output.ewarn("Failed to download the rubygems versions file")
+        if fp.status == 206:
+            with open(path, "ab") as f:
+                f.truncate(size)
+        elif os.path.exists(path + ".tmp"):
+            os.unlink(path + ".tmp")
+
+
+def load_versions():
+    """
+    Index the compact index versions file by gem, the versions fields are
+    only split when the gem is looked up
+    """
+    global _versions
+
+    if _versions is not None:
+        return _versions
+
+    path = os.path.join(cache.cache_dir("rubygems"), "versions")
+    update_versions_file(path)
+
+    versions = {}
+    try:
+        with open(path, "rb") as fp:
+            header = True
+            for line in fp:
+                if header:
+                    header = line.strip() != b"---"
+                    continue
+                fields = line.split(b" ")
+                if len(fields) == 3:
+                    versions.setdefault(fields[0].decode(), []).append(fields[1])
+    except OSError:
+        # Neither downloaded nor cached, the next gem tries again
+        return {}
+
+    _versions = versions
+    return _versions
+
+
+def gem_versions(gem):
+    """
+    Return the versions of a gem, without yanked ones
+    """
+    versions = {}
+
+    if cache.cache_dir("rubygems"):
+        for field in load_versions().get(gem, []):
+            for version in field.decode().split(","):
+                if version.startswith("-"):
+                    versions.pop(version[1:], None)
+                else:
+                    versions[version] = None
+    else:
+        response = helpers.urlopen_cached(f"{RUBYGEMS_URL}/info/{gem}")
+        if not response:
+            return []
+        header = True
+        for line in response[1].decode().splitlines():
+            if header:
+                header = line.strip() != "---"
+                continue
+            versions[line.split(" ", 1)[0]] = None
+
+    # Strip platforms (e.g.: 1.0.0-java)
+    return list(dict.fromkeys(version.split("-", 1)[0] for version in versions))
+
+
+def scan_pkg(pkg, options):
+    "https://guides.rubygems.org/rubygems-org-compact-index-api/"
+
+    gem = options["data"]
+
+    versions = gem_versions(gem)
+    if not versions:
+        return []
 
     cp, ver, rev = portage.pkgsplit(pkg.cpv)
 
     ret = []
-    for version in versions:
-        up_pv = version["number"]
+    for up_pv in versions:
         pv = mangling.mangle_version(up_pv, options)
         if helpers.version_filtered(cp, ver, pv):
             continue
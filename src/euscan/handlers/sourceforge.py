@@ -3,17 +3,18 @@
 # Distributed under the terms of the GNU General Public License v2
 
 import re
+from xml.etree import ElementTree
 
 import portage
 
-from euscan import output
-from euscan.handlers.url import process_scan as url_scan
-from euscan.helpers import regex_from_template
+from euscan import helpers, mangling, output
 
 HANDLER_NAME = "sourceforge"
 CONFIDENCE = 90
 PRIORITY = 90
 
+SOURCEFORGE_URL = "https://sourceforge.net/projects"
+
 
 def can_handle(pkg, url=None):
     if not url:
@@ -26,7 +27,23 @@ def can_handle(pkg, url=None):
     return "mirror://sourceforge/" in url
 
 
+def parse_rss(fp):
+    """
+    Keep the path of the files listed in a project files RSS feed
+    """
+    files = []
+    for _event, element in ElementTree.iterparse(fp):
+        if element.tag == "item":
+            title = element.findtext("title")
+            if title:
+                files.append(title.strip())
+            element.clear()
+    return {"files": files}
+
+
 def scan_url(pkg, url, options):
+    "https://sourceforge.net/p/forge/documentation/RSS%20Feeds/"
+
     output.einfo("Using SourceForge handler")
 
     cp, ver, rev = portage.pkgsplit(pkg.cpv)
@@ -35,12 +52,22 @@ def scan_url(pkg, url, options):
         "mirror://sourceforge/([^/]+)/(?:.*/)?([^/]+)", url
     ).groups()
 
-    base_url = "http://qa.debian.org/watch/sf.php/%s" % project
-    file_pattern = regex_from_template(filename.replace(ver, "${PV}"))
+    file_pattern = helpers.regex_from_template(filename.replace(ver, "${PV}"))
 
-    result = url_scan(pkg, base_url, file_pattern)
+    rss_url = f"{SOURCEFORGE_URL}/{project}/rss?path=/"
+    files = helpers.urlopen_index(rss_url, parse_rss, "sourceforge").get("files", [])
 
     ret = []
-    for url, pv, _, _ in result:
-        ret.append((url, pv, HANDLER_NAME, CONFIDENCE))
+    for path in files:
+        match = re.match(file_pattern, path.rsplit("/", 1)[-1], re.I)
+        if not match:
+            continue
+
+        up_pv = ".".join([x for x in match.groups() if x is not None])
+        pv = mangling.mangle_version(up_pv, options)
+        if helpers.version_filtered(cp, ver, pv):
+            continue
+
+        new_url = mangling.mangle_url(f"mirror://sourceforge/{project}{path}", options)
+        ret.append((new_url, pv, HANDLER_NAME, CONFIDENCE))
     return ret
@@ -3,11 +3,8 @@
 # Distributed under the terms of the GNU General Public License v2
 
 import re
-import urllib.error
-import urllib.parse
-import urllib.request
 
-from euscan import helpers, output
+from euscan import output
 from euscan.handlers import generic
 
 PRIORITY = 100
@@ -41,22 +38,11 @@ def handle_directory_patterns(base, file_pattern):
     directory_pattern = splitted[i]
     final = "/".join(splitted[i + 1 :])
 
-    try:
-        fp = helpers.urlopen(basedir)
-    except urllib.error.URLError:
-        return []
-    except OSError:
-        return []
-
-    if not fp:
+    links = generic.fetch_listing(basedir)
+    if not links:
         return []
 
-    data = fp.read()
-
-    if basedir.startswith("ftp://"):
-        scan_data = generic.scan_ftp(data, basedir, directory_pattern)
-    else:
-        scan_data = generic.scan_html(data, basedir, directory_pattern)
+    scan_data = generic.match_links(links, directory_pattern)
 
     return [("/".join((basedir, path, final)), file_pattern) for _, path in scan_data]
 
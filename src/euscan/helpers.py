@@ -2,21 +2,53 @@
 # Copyright 2020-2023 src_prepare group
 # Distributed under the terms of the GNU General Public License v2
 
+import bz2
+import codecs
+import datetime
 import errno
+import functools
+import io
+import json
+import lzma
 import os
 import re
+import socket
+import time
 import urllib
 import urllib.error
 import urllib.parse
 import urllib.request
+import urllib.response
 import urllib.robotparser
+import zlib
 from xml.dom.minidom import Document
+from xml.etree.ElementTree import ParseError
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 import portage
 from portage import dep
 
 import euscan
-from euscan import BLACKLIST_VERSIONS, CONFIG, ROBOTS_TXT_BLACKLIST_DOMAINS
+from euscan import (
+    BLACKLIST_VERSIONS,
+    CONFIG,
+    ROBOTS_TXT_BLACKLIST_DOMAINS,
+    breaker,
+    budget,
+    cache,
+    latency,
+    mirrors,
+    resolver,
+)
 from euscan.version import parse_version
 
 
@@ -34,6 +66,9 @@ VERSION_CMP_PACKAGE_QUIRKS = {"sys-process/htop": htop_vercmp}
 _v_end = r"(?:(?:-|_)(?:pre|p|beta|b|alpha|a|rc|r)\d*)"
 _v = r"((?:\d+)(?:(?:\.\d+)*)(?:[a-zA-Z]*?)(?:" + _v_end + "*))"
 
+_component_re = re.compile(r"(\d+ | [a-z]+ | \.)", re.VERBOSE)
+_template_var_re = re.compile(r"\$\{(PV|\d+)\}")
+
 
 def cast_int_components(version):
     for i, obj in enumerate(version):
@@ -146,10 +181,10 @@ def template_from_url(url, version):
     prefix, chunks = url.split("://")
     chunks = chunks.split("/")
 
+    subs = generate_templates_vars(version)
     for i in range(len(chunks)):
         chunk = chunks[i]
 
-        subs = generate_templates_vars(version)
         for sub in subs:
             chunk = chunk.replace(sub[0], sub[1])
 
@@ -168,23 +203,96 @@ def url_from_template(url, version):
     return url
 
 
-# Stolen from distutils.LooseVersion
-# Used for brute force to increment the version
-def split_version(version):
-    component_re = re.compile(r"(\d+ | [a-z]+ | \.)", re.VERBOSE)
-    components = [x for x in component_re.split(version) if x and x != "."]
+class Template:
+    """
+    A url with its version replaced by ${PV} and ${N} variables, parsed
+    once so that urls of other versions are cheap to build
+    """
+
+    def __init__(self, url, version):
+        self.url = url
+        self.version = version
+        self.template = template_from_url(url, version)
+        self.steps = generate_scan_paths(self.template)
+        # Literals and variable names, alternately
+        self._parts = _template_var_re.split(self.template)
+
+    def __str__(self):
+        return self.template
+
+    def depends_on_version(self, full=False):
+        return ("${PV}" if full else "${") in self.template
+
+    def format(self, version):
+        """
+        Same as url_from_template(self.template, version)
+        """
+        components = split_version(version)
+        url = []
+        for i, part in enumerate(self._parts):
+            if not i % 2:
+                url.append(part)
+            elif part == "PV":
+                url.append(version)
+            elif int(part) < len(components):
+                url.append(str(components[int(part)]))
+            else:
+                url.append("${%s}" % part)
+        return "".join(url)
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_template(url, version):
+    return Template(url, version)
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_pattern(pattern, flags=0):
+    return re.compile(pattern, flags)
+
+
+@functools.lru_cache(maxsize=4096)
+def _split_version(version):
+    components = [x for x in _component_re.split(version) if x and x != "."]
     for i in range(len(components)):
         try:
             components[i] = int(components[i])
         except ValueError:
             pass
-    return components
+    return tuple(components)
+
+
+# Stolen from distutils.LooseVersion
+# Used for brute force to increment the version
+def split_version(version):
+    return list(_split_version(version))
+
+
+def version_widths(version):
+    """
+    Width of each zero padded numeric component of version, 0 for the
+    other components
+    """
+    return [
+        len(x) if x.isdigit() and len(x) > 1 and x[0] == "0" else 0
+        for x in _component_re.split(version)
+        if x and x != "."
+    ]
 
 
-def join_version(components):
+def join_version(components, widths=()):
+    """
+    Join version components, numbers are zero padded to the given widths
+
+    >>> join_version([2024, 6, 0], version_widths("2024.05.1"))
+    '2024.06.0'
+    """
     version = ""
     for i in range(len(components)):
-        version += str(components[i])
+        if isinstance(components[i], int) and i < len(widths) and widths[i]:
+            version += "%0*d" % (widths[i], components[i])
+        else:
+            version += str(components[i])
         if i >= len(components) - 1:
             break
         if not isinstance(components[i], str) and not isinstance(
@@ -229,12 +337,157 @@ def gen_versions(components, level):
     return versions
 
 
+def is_calendar_version(components):
+    """
+    Whether components look like a date based version, e.g. 2023.04.1
+    """
+    return (
+        len(components) > 1
+        and all(isinstance(c, int) for c in components)
+        and 1990 <= components[0] <= datetime.date.today().year
+    )
+
+
+def gen_calendar_versions(components, today=None):
+    """
+    Generate the versions released since components for date based
+    schemes, YYYY.x or YYYY.MM.x, up to today
+
+    >>> versions = gen_calendar_versions([2024, 5, 1], datetime.date(2024, 7, 1))
+    >>> [join_version(v, version_widths("2024.05.1")) for v in versions]
+    ['2024.06.0', '2024.07.0']
+    """
+    today = today or datetime.date.today()
+    n = len(components)
+    versions = []
+
+    if 1 <= components[1] <= 12:
+        year, month = components[0], components[1]
+        while (year, month) < (today.year, today.month):
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+            versions.append([year, month] + [0] * (n - 2))
+    else:
+        for year in range(components[0] + 1, today.year + 1):
+            versions.append([year] + [0] * (n - 1))
+            versions.append([year, 1] + [0] * (n - 2))
+
+    return versions
+
+
+def version_steps(versions):
+    """
+    Count how often each component was bumped, and by how much, between
+    consecutive versions: {(index, step): count}
+    """
+    steps = {}
+    versions = sorted(set(versions), key=functools.cmp_to_key(simple_vercmp))
+    previous = None
+
+    for version in versions:
+        components = split_version(version)
+        if previous and len(previous) == len(components):
+            for i, (a, b) in enumerate(zip(previous, components)):
+                if a == b:
+                    continue
+                if isinstance(a, int) and isinstance(b, int) and b > a:
+                    steps[(i, b - a)] = steps.get((i, b - a), 0) + 1
+                break
+        previous = components
+
+    return steps
+
+
+def version_likelihood(components, candidate, steps):
+    """
+    Score a candidate version: bumps of the last components and small
+    steps are the most likely, adjusted by the package's own history
+    """
+    n = len(components)
+    for i in range(min(n, len(candidate))):
+        if candidate[i] != components[i]:
+            break
+    else:
+        return 0.0
+
+    if isinstance(candidate[i], int) and isinstance(components[i], int):
+        step = candidate[i] - components[i]
+    else:
+        step = 1
+    if step <= 0:
+        return 0.0
+
+    # Patch bumps before minor before major, small steps first, following
+    # components reset. Each prior weighs as much as two known releases
+    level_prior = 2 / 2 ** (n - 1 - i)
+    step_prior = 2 / step**2
+    reset_prior = 1 / (1 + sum(c for c in candidate[i + 1 :] if isinstance(c, int)))
+
+    total = sum(steps.values())
+    level_count = sum(count for (j, _), count in steps.items() if j == i)
+    step_count = steps.get((i, step), 0)
+
+    return (
+        (level_count + level_prior)
+        / (total + 2)
+        * (step_count + step_prior)
+        / (level_count + 2)
+        * reset_prior
+    )
+
+
+def rank_versions(components, versions, history=()):
+    """
+    Sort candidate versions generated from components, most likely first,
+    dropping duplicates
+    """
+    steps = version_steps(history)
+    seen = set()
+    unique = []
+    for version in versions:
+        if tuple(version) not in seen:
+            seen.add(tuple(version))
+            unique.append(version)
+
+    return sorted(
+        unique,
+        key=lambda v: version_likelihood(components, v, steps),
+        reverse=True,
+    )
+
+
+def package_versions(cp):
+    """
+    Versions of cp available in the configured repositories
+    """
+    try:
+        portdb = portage.db[portage.root]["porttree"].dbapi
+        return [portage.catpkgsplit(cpv)[2] for cpv in portdb.cp_list(cp)]
+    except (AttributeError, KeyError):
+        return []
+
+
 def timeout_for_url(url):
+    """
+    Read timeout for url, learned from the latencies of its host, with a
+    guess for hosts without enough measurements yet
+    """
     if "sourceforge" in url:
         timeout = 15
     else:
         timeout = 5
-    return timeout
+    return latency.read_timeout(latency.host_of(url), timeout)
+
+
+def _timed_out(error):
+    if isinstance(error, urllib.error.URLError):
+        error = error.reason
+    # socket.timeout is only an alias of TimeoutError since Python 3.10
+    return isinstance(error, (TimeoutError, socket.timeout))
+
+
+# Additional urllib handlers used for every request,
+# e.g. to replay recorded responses in benchmarks
+opener_handlers = []
 
 
 class HeadRequest(urllib.request.Request):
@@ -242,6 +495,94 @@ class HeadRequest(urllib.request.Request):
         return "HEAD"
 
 
+# Content codings asked for, brotli and zstd when their modules are available
+ACCEPT_ENCODING = ", ".join(
+    ["gzip", "deflate"] + ["br"] * bool(brotli) + ["zstd"] * bool(zstandard)
+)
+
+# Files already compressed, not worth asking for a content coding
+COMPRESSED_EXTENSIONS = (".gz", ".tgz", ".bz2", ".xz", ".zst", ".zip")
+
+
+def _content_decoder(encoding):
+    """
+    Return a function decompressing chunks of a Content-Encoding, or None
+    """
+    if encoding in ("gzip", "x-gzip"):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress
+    if encoding == "deflate":
+        return zlib.decompressobj().decompress
+    if encoding == "br" and brotli:
+        return brotli.Decompressor().process
+    if encoding == "zstd" and zstandard:
+        return zstandard.ZstdDecompressor().decompressobj().decompress
+    return None
+
+
+class DecodedStream(io.RawIOBase):
+    """
+    Raw stream decompressing a response body while it is read
+    """
+
+    def __init__(self, fp, decompress, chunk_size=64 * 1024):
+        self.fp = fp
+        self.decompress = decompress
+        self.chunk_size = chunk_size
+        self.pending = b""
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.offset >= len(self.pending):
+            chunk = self.fp.read(self.chunk_size)
+            if not chunk:
+                return 0
+            self.pending = self.decompress(chunk)
+            self.offset = 0
+
+        size = min(len(buffer), len(self.pending) - self.offset)
+        buffer[:size] = self.pending[self.offset : self.offset + size]
+        self.offset += size
+        return size
+
+    def close(self):
+        self.fp.close()
+        super().close()
+
+
+class DecodingHandler(urllib.request.BaseHandler):
+    """
+    Decompress the bodies of responses to requests sent with
+    Accept-Encoding, while they are read
+    """
+
+    def http_response(self, request, response):
+        if not request.has_header("Accept-encoding"):
+            return response
+
+        encoding = response.headers.get("Content-Encoding", "").strip().lower()
+        decompress = _content_decoder(encoding) if encoding else None
+        if decompress is None:
+            return response
+
+        headers = response.headers
+        del headers["Content-Encoding"]
+        del headers["Content-Length"]
+
+        decoded = urllib.response.addinfourl(
+            io.BufferedReader(DecodedStream(response, decompress)),
+            headers,
+            response.geturl(),
+            response.status,
+        )
+        decoded.msg = response.msg
+        return decoded
+
+    https_response = http_response
+
+
 # RobotParser cache
 rpcache = {}
 
@@ -263,6 +604,10 @@ def urlallowed(url):
     if protocol == "ftp":
         return True
 
+    # Requests to it are short-circuited anyway
+    if breaker.is_open(latency.host_of(url)):
+        return True
+
     baseurl = f"{protocol}://{domain}"
     robotsurl = urllib.parse.urljoin(baseurl, "robots.txt")
 
@@ -287,7 +632,7 @@ def urlallowed(url):
     return rp.can_fetch(CONFIG["user-agent"], url) if rp else True
 
 
-def urlopen(url, timeout=None, verb="GET"):
+def urlopen(url, timeout=None, verb="GET", headers=None, data=None):
     if not urlallowed(url):
         euscan.output.einfo(f"Url '{url}' blocked by robots.txt")
         return None
@@ -295,29 +640,344 @@ def urlopen(url, timeout=None, verb="GET"):
     if not timeout:
         timeout = timeout_for_url(url)
 
+    host = latency.host_of(url)
+    try:
+        breaker.check(host)
+    except breaker.HostUnavailable:
+        # Counted as a failure, for mirror failover to move on
+        mirrors.record_url(url)
+        raise
+
+    mirrors.fetching(url)
+    budget.charge()
+    timeout = budget.timeout(timeout)
+
     if verb == "GET":
         request = urllib.request.Request(url)
+    elif verb == "POST":
+        request = urllib.request.Request(url, data=data)
     elif verb == "HEAD":
         request = HeadRequest(url)
     else:
         return None
 
     request.add_header("User-Agent", CONFIG["user-agent"])
+    for key, value in (headers or {}).items():
+        request.add_header(key, value)
+
+    # Ranges of a compressed representation can't be appended to a file
+    if (
+        verb != "HEAD"
+        and not request.has_header("Range")
+        and not request.has_header("Accept-encoding")
+        and not urllib.parse.urlsplit(url).path.endswith(COMPRESSED_EXTENSIONS)
+    ):
+        request.add_header("Accept-Encoding", ACCEPT_ENCODING)
+
+    debuglevel = max(CONFIG["verbose"] - 1, 0)
+    handlers = list(opener_handlers) + [
+        resolver.HTTPHandler(debuglevel=debuglevel),
+        resolver.HTTPSHandler(debuglevel=debuglevel),
+        DecodingHandler(),
+    ]
+
+    opener = urllib.request.build_opener(*handlers)
+
+    for attempt in range(2):
+        start = time.monotonic()
+        try:
+            fp = opener.open(request, None, timeout)
+        except urllib.error.HTTPError as e:
+            # Hosts answering errors are still alive, unless overloaded
+            overloaded = e.code >= 500 or e.code == 429
+            if overloaded:
+                mirrors.record_url(url)
+                if breaker.failure(host):
+                    euscan.output.ewarn(
+                        f"{host} is unavailable, skipping it from now on"
+                    )
+            else:
+                elapsed = time.monotonic() - start
+                mirrors.record_url(url, elapsed)
+                latency.record(host, "response", elapsed)
+                breaker.success(host)
+            raise
+        except OSError as e:
+            mirrors.record_url(url)
+            if breaker.failure(host):
+                euscan.output.ewarn(f"{host} is unavailable, skipping it from now on")
+                raise
+            # A stalled request to a host known to answer quickly is more
+            # likely a lost connection than an overloaded host, try again
+            retry = not attempt and verb != "POST" and _timed_out(e)
+            if not retry or not latency.stalled(host, time.monotonic() - start):
+                raise
+            budget.charge()
+            continue
+        elapsed = time.monotonic() - start
+        mirrors.record_url(url, elapsed)
+        latency.record(host, "response", elapsed)
+        breaker.success(host)
+        return fp
+
+
+def urlopen_cached(url, headers=None, timeout=None):
+    """
+    Fetch url, revalidating a previously stored copy with
+    If-None-Match/If-Modified-Since.
+    Returns a (headers, body) pair, or None on failure
+    """
+    cached = cache.load_response(url)
+
+    headers = dict(headers or {})
+    if cached:
+        cached_headers = cached[0]
+        if "ETag" in cached_headers:
+            headers["If-None-Match"] = cached_headers["ETag"]
+        if "Last-Modified" in cached_headers:
+            headers["If-Modified-Since"] = cached_headers["Last-Modified"]
+
+    try:
+        fp = urlopen(url, timeout=timeout, headers=headers)
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and cached:
+            return cached
+        return None
+    except urllib.error.URLError:
+        return None
+    except OSError:
+        return None
+
+    if not fp:
+        return None
 
-    handlers = []
+    body = fp.read()
+    info = fp.info()
+    response_headers = {
+        key: info[key] for key in ("ETag", "Last-Modified", "Link") if key in info
+    }
+    cache.store_response(url, response_headers, body)
+
+    return response_headers, body
+
+
+def _decompressor(url):
+    if url.endswith(".bz2"):
+        return bz2.BZ2Decompressor()
+    if url.endswith(".gz"):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if url.endswith(".xz"):
+        return lzma.LZMADecompressor()
+    return None
+
+
+def iter_lines(fp, url, chunk_size=64 * 1024):
+    """
+    Iterate over the lines of a response while it is downloaded,
+    decompressing it on the fly depending on the url extension
+    """
+    decompressor = _decompressor(url)
+    pending = b""
+
+    while True:
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            break
+        if decompressor:
+            chunk = decompressor.decompress(chunk)
 
-    if CONFIG["cache"]:
-        from cache import CacheHandler
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        yield from lines
 
-        handlers.append(CacheHandler(CONFIG["cache"]))
+    if pending:
+        yield pending
 
-    if CONFIG["verbose"]:
-        debuglevel = CONFIG["verbose"] - 1
-        handlers.append(urllib.request.HTTPHandler(debuglevel=debuglevel))
 
-    opener = urllib.request.build_opener(*handlers)
+def iter_text(fp, chunk_size=64 * 1024):
+    """
+    Iterate over the text of a response while it is downloaded, decoded
+    with the charset of its Content-Type
+    """
+    charset = None
+    if hasattr(fp, "headers"):
+        charset = fp.headers.get_content_charset()
+    try:
+        decoder = codecs.getincrementaldecoder(charset or "utf-8")("replace")
+    except LookupError:
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+
+    while True:
+        chunk = fp.read(chunk_size)
+        text = decoder.decode(chunk, final=not chunk)
+        if text:
+            yield text
+        if not chunk:
+            break
+
+
+_whitespace_re = re.compile(r"\s*")
+
+
+def iter_json_array(fp, chunk_size=64 * 1024):
+    """
+    Iterate over the elements of a JSON array while it is downloaded,
+    each element is decoded as soon as it is complete
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter_text(fp, chunk_size)
+    buffer = ""
+    pos = 0
+    eof = False
+    expected = "["
+
+    def more():
+        nonlocal buffer, pos, eof
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+            return False
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        return True
+
+    while True:
+        pos = _whitespace_re.match(buffer, pos).end()
+        if pos == len(buffer):
+            if not more():
+                raise ValueError("Unterminated JSON array")
+            continue
+
+        char = buffer[pos]
+        if expected == "[":
+            if char != "[":
+                raise ValueError("Not a JSON array")
+            pos += 1
+            expected = "value or ]"
+            continue
+        if char == "]" and expected != "value":
+            return
+        if expected == ",":
+            if char != ",":
+                raise ValueError(f"Unexpected {char!r} in JSON array")
+            pos += 1
+            expected = "value"
+            continue
+
+        try:
+            value, end = decoder.raw_decode(buffer, pos)
+        except ValueError:
+            if eof:
+                raise
+            more()
+            continue
+
+        # Numbers may go on in the next chunk
+        if not eof and (end == len(buffer) or buffer[end] in "+-.0123456789Ee"):
+            more()
+            continue
+
+        pos = end
+        expected = ","
+        yield value
+
+
+# Indexes built by urlopen_index, by url
+_indexes = {}
+
+
+def reset_indexes():
+    """
+    Forget the indexes built so far, they are fetched or revalidated again
+    """
+    _indexes.clear()
 
-    return opener.open(request, None, timeout)
+
+def urlopen_index(url, parse, kind):
+    """
+    Return the index built by parse(fp) from the given url.
+    Each url is only fetched once per run, indexes are also kept in the
+    cache directory and revalidated with conditional requests
+    """
+    if url in _indexes:
+        return _indexes[url]
+
+    name = cache.cache_key(url) + ".json"
+    cached = cache.load_json(name, kind)
+
+    headers = {}
+    if cached:
+        cached_headers = cached.get("headers", {})
+        if "ETag" in cached_headers:
+            headers["If-None-Match"] = cached_headers["ETag"]
+        if "Last-Modified" in cached_headers:
+            headers["If-Modified-Since"] = cached_headers["Last-Modified"]
+
+    index = None
+    try:
+        fp = urlopen(url, headers=headers)
+        if fp:
+            index = parse(fp)
+            info = fp.info()
+            response_headers = {
+                key: info[key] for key in ("ETag", "Last-Modified") if key in info
+            }
+            cache.store_json(name, {"headers": response_headers, "index": index}, kind)
+    except budget.BudgetExceeded:
+        # Let the next package fetch it
+        return (cached or {}).get("index") or {}
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and cached:
+            index = cached.get("index")
+    except urllib.error.URLError:
+        pass
+    except OSError:
+        pass
+    except (
+        EOFError,
+        KeyError,
+        IndexError,
+        ValueError,
+        ParseError,
+        lzma.LZMAError,
+        zlib.error,
+    ):
+        euscan.output.ewarn("Invalid index: " + url)
+
+    _indexes[url] = index or {}
+    return _indexes[url]
+
+
+def parse_link_header(value):
+    """
+    Parse a RFC 8288 Link header into a {rel: url} dict
+    """
+    links = {}
+    for link in (value or "").split(","):
+        match = re.match(r'\s*<([^>]*)>.*;\s*rel="?([^";]+)"?', link)
+        if match:
+            links[match.group(2)] = match.group(1)
+    return links
+
+
+def json_pages(url, headers=None):
+    """
+    Lazily iterate over the pages of a paginated JSON API,
+    following Link: rel="next" headers
+    """
+    while url:
+        response = urlopen_cached(url, headers)
+        if not response:
+            return
+
+        response_headers, body = response
+        yield json.loads(body)
+
+        url = parse_link_header(response_headers.get("Link")).get("next")
+
+
+def api_token(domain):
+    return CONFIG["api-tokens"].get(domain)
 
 
 def tryurl(fileurl, template):
@@ -327,6 +987,16 @@ def tryurl(fileurl, template):
         euscan.output.einfo("Url '%s' blocked by robots.txt" % fileurl)
         return None
 
+    found = cache.load_probe(fileurl)
+    if found is not None:
+        euscan.output.ebegin("Trying: " + fileurl + " (cached)")
+        euscan.output.eend(errno.ENOENT if not found else 0)
+        return result if found else None
+
+    if breaker.is_open(latency.host_of(fileurl)):
+        euscan.output.einfo(f"Skipping: {fileurl} (host unavailable)")
+        return None
+
     euscan.output.ebegin("Trying: " + fileurl)
 
     try:
@@ -354,19 +1024,26 @@ def tryurl(fileurl, template):
         ):
             result = None
         elif fp.geturl() != fileurl:
-            regex = regex_from_template(template)
-            baseregex = regex_from_template(os.path.basename(template))
+            regex = compile_pattern(regex_from_template(template))
+            baseregex = compile_pattern(regex_from_template(os.path.basename(template)))
             basename2 = os.path.basename(fp.geturl())
 
             # Redirect to another (earlier?) version
             if basename != basename2 and (
-                re.match(regex, fp.geturl()) or re.match(baseregex, basename2)
+                regex.match(fp.geturl()) or baseregex.match(basename2)
             ):
                 result = None
 
             if result:
                 result = (fp.geturl(), fp.info())
 
+        cache.store_probe(fileurl, bool(result))
+
+    except urllib.error.HTTPError as e:
+        # Only remember definitive answers, not transient failures
+        if e.code in (404, 410):
+            cache.store_probe(fileurl, False)
+        result = None
     except urllib.error.URLError:
         result = None
     except OSError:
@@ -377,6 +1054,7 @@ def tryurl(fileurl, template):
     return result
 
 
+@functools.lru_cache(maxsize=4096)
 def regex_from_template(template):
     # Escape
     regexp = re.escape(template)
@@ -434,38 +1112,36 @@ def generate_scan_paths(url):
 
 
 def parse_mirror(uri):
-    from random import shuffle
-
-    mirrors = portage.settings.thirdpartymirrors()
-
+    """
+    Resolve a mirror:// uri to its best mirror, see parse_mirrors()
+    """
+    uris = parse_mirrors(uri)
+    return uris[0] if uris else None
+
+
+def parse_mirrors(uri):
+    """
+    Return the urls of uri on each of its mirrors, fastest healthy ones
+    first, or [uri] if it isn't a mirror:// uri
+    """
     if not uri.startswith("mirror://"):
-        return uri
+        return [uri]
 
-    eidx = uri.find("/", 9)
-    if eidx == -1:
+    split = mirrors.split(uri)
+    if split is None:
         euscan.output.einfo("Invalid mirror definition in SRC_URI:\n")
         euscan.output.einfo("  %s\n" % (uri))
-        return None
-
-    mirrorname = uri[9:eidx]
-    path = uri[eidx + 1 :]
+        return []
 
-    if mirrorname in mirrors:
-        mirrors = mirrors[mirrorname]
-        shuffle(mirrors)
-        uri = mirrors[0].strip("/") + "/" + path
-    else:
+    mirrorname = split[0]
+    if mirrorname not in mirrors.load_mirrors():
         euscan.output.einfo("No known mirror by the name: %s" % (mirrorname))
-        return None
+        return []
 
-    return uri
+    return mirrors.resolve(uri)
 
 
-def dict_to_xml(data, indent):
-    doc = Document()
-    root = doc.createElement("euscan")
-    doc.appendChild(root)
-
+def _xml_package(doc, name, value):
     def _set_value(parent, value):
         if isinstance(value, dict):
             for k, v in list(value.items()):
@@ -482,10 +1158,83 @@ def dict_to_xml(data, indent):
             text = doc.createTextNode(str(value))
             parent.appendChild(text)
 
+    node = doc.createElement("package")
+    node.setAttribute("name", name)
+    _set_value(node, value)
+    return node
+
+
+class JSONWriter:
+    """
+    Write a {query: data} JSON object to fp one query at a time, same as
+    json.dumps(data, indent=indent)
+    """
+
+    def __init__(self, fp, indent):
+        self.fp = fp
+        self.indent = indent
+        self.count = 0
+
+    def write(self, name, value):
+        if self.indent is None:
+            separator = ", " if self.count else "{"
+            value = json.dumps(value)
+        else:
+            newline = "\n" + " " * self.indent
+            separator = ("," if self.count else "{") + newline
+            # Strings are escaped, every newline is an indentation
+            value = json.dumps(value, indent=self.indent).replace("\n", newline)
+        self.fp.write(f"{separator}{json.dumps(name)}: {value}")
+        self.count += 1
+
+    def close(self):
+        if not self.count:
+            self.fp.write("{}")
+        elif self.indent is None:
+            self.fp.write("}")
+        else:
+            self.fp.write("\n}")
+
+
+class XMLWriter:
+    """
+    Write the <euscan> document to fp one <package> element at a time,
+    same as dict_to_xml(data, indent)
+    """
+
+    def __init__(self, fp, indent):
+        self.fp = fp
+        self.indent = " " * indent
+        self.count = 0
+        self.doc = Document()
+        self.fp.write('<?xml version="1.0" ?>\n<euscan')
+
+    def write(self, name, value):
+        if not self.count:
+            self.fp.write(">\n")
+        node = _xml_package(self.doc, name, value)
+        node.writexml(self.fp, self.indent, self.indent, "\n")
+        node.unlink()
+        self.count += 1
+
+    def close(self):
+        self.fp.write("</euscan>\n" if self.count else "/>\n")
+
+
+def output_writer(fp, format_, indent):
+    if format_.lower() == "json":
+        return JSONWriter(fp, indent)
+    elif format_.lower() == "xml":
+        return XMLWriter(fp, indent)
+    raise TypeError("Invalid output format")
+
+
+def dict_to_xml(data, indent):
+    doc = Document()
+    root = doc.createElement("euscan")
+    doc.appendChild(root)
+
     for key, value in list(data.items()):
-        node = doc.createElement("package")
-        node.setAttribute("name", key)
-        _set_value(node, value)
-        root.appendChild(node)
+        root.appendChild(_xml_package(doc, key, value))
 
     return doc.toprettyxml(indent=" " * indent)
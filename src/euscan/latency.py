@@ -0,0 +1,114 @@
+# Copyright 2020-2024 src_prepare group
+# Distributed under the terms of the GNU General Public License v2
+
+"""
+Per-host connection and response latencies, kept in the cache directory
+between runs, used to give each host timeouts matching how fast it
+usually is instead of the same ones for every host.
+"""
+
+import atexit
+import math
+import threading
+import urllib.parse
+
+from euscan import cache
+
+# Latest samples kept per host and kind, and needed to trust them
+SAMPLES = 64
+MIN_SAMPLES = 5
+
+# Timeouts are the 99th percentile times FACTOR, within these bounds
+FACTOR = 3
+CONNECT_TIMEOUT = (1, 10)
+READ_TIMEOUT = (2, 30)
+
+# {"host:port": {"connect": [seconds], "response": [seconds]}}
+_stats = None
+_dirty = False
+_lock = threading.Lock()
+
+
+def _load_stats():
+    global _stats
+    if _stats is None:
+        _stats = cache.load_json("latency.json") or {}
+        atexit.register(save_stats)
+    return _stats
+
+
+def save_stats():
+    global _dirty
+    if _dirty:
+        with _lock:
+            cache.store_json("latency.json", _stats)
+        _dirty = False
+
+
+def reset():
+    """
+    Save and forget the latencies loaded or recorded so far
+    """
+    global _stats
+    save_stats()
+    atexit.unregister(save_stats)
+    _stats = None
+
+
+def host_of(url):
+    """
+    Return the host:port key of url
+    """
+    parts = urllib.parse.urlsplit(url)
+    port = parts.port or {"http": 80, "https": 443, "ftp": 21}.get(parts.scheme)
+    return f"{parts.hostname}:{port}"
+
+
+def record(host, kind, seconds):
+    """
+    Record a "connect" or "response" latency of host
+    """
+    global _dirty
+
+    stats = _load_stats()
+    with _lock:
+        samples = stats.setdefault(host, {}).setdefault(kind, [])
+        samples.append(round(seconds, 3))
+        del samples[:-SAMPLES]
+        _dirty = True
+
+
+def percentile(host, kind, p=0.99):
+    """
+    Return the p percentile of the latencies of host, or None when there
+    are not enough samples yet
+    """
+    with _lock:
+        samples = sorted(_load_stats().get(host, {}).get(kind, ()))
+    if len(samples) < MIN_SAMPLES:
+        return None
+    return samples[min(len(samples) - 1, math.ceil(p * len(samples)) - 1)]
+
+
+def stalled(host, seconds):
+    """
+    Whether waiting seconds for host is far beyond its usual response
+    time, False when it is not known yet
+    """
+    usual = percentile(host, "response", 0.5)
+    return usual is not None and seconds > usual * FACTOR
+
+
+def _timeout(host, kind, bounds, default):
+    value = percentile(host, kind)
+    if value is None:
+        return default
+    return min(max(value * FACTOR, bounds[0]), bounds[1])
+
+
+def connect_timeout(host, default):
+    return _timeout(host, "connect", CONNECT_TIMEOUT, default)
+
+
+def read_timeout(host, default):
+    return _timeout(host, "response", READ_TIMEOUT, default)
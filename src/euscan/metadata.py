@@ -0,0 +1,112 @@
+# Copyright 2020-2024 src_prepare group
+# Distributed under the terms of the GNU General Public License v2
+
+"""
+Index of the upstream <watch> and <remote-id> data of metadata.xml files,
+kept in the cache directory and validated against the files mtime, so
+that tree-wide runs only parse the files that changed.
+"""
+
+import atexit
+import copy
+import os
+import xml.etree.ElementTree
+
+from euscan import cache
+
+# {path: [mtime_ns, size, metadata]}
+_index = None
+_dirty = False
+
+
+def _load_index():
+    global _index
+    if _index is None:
+        _index = cache.load_json("metadata.json") or {}
+        atexit.register(save_index)
+    return _index
+
+
+def save_index():
+    global _dirty
+    if _dirty:
+        cache.store_json("metadata.json", _index)
+        _dirty = False
+
+
+def reset():
+    """
+    Save and forget the metadata.xml index
+    """
+    global _index
+    save_index()
+    atexit.unregister(save_index)
+    _index = None
+
+
+def parse_upstream(root):
+    """
+    Return the handlers options found in the <upstream> elements of a
+    metadata.xml tree: {handler: [options]}
+    """
+    metadata = {}
+    upstreams = root.findall("upstream")
+
+    # Support multiple remote-id and multiple watch
+    for upstream in upstreams:
+        for node in upstream.findall("watch"):
+            options = dict(node.attrib)
+            options["data"] = node.text
+
+            if "type" in options:
+                handler = options["type"]
+            else:
+                handler = "url"
+                options["type"] = "url"
+
+            for key in ["versionmangle", "downloadurlmangle"]:
+                value = options.get(key, None)
+                if value:
+                    options[key] = value.split(";")
+
+            if handler not in metadata:
+                metadata[handler] = []
+            metadata[handler].append(options)
+
+    for upstream in upstreams:
+        for node in upstream.findall("remote-id"):
+            handler = node.attrib.get("type")
+            if not handler:
+                continue
+            if handler in metadata:
+                for i in range(len(metadata[handler])):
+                    if not metadata[handler][i]["data"]:
+                        metadata[handler][i]["data"] = node.text
+            else:
+                metadata[handler] = [{"type": handler, "data": node.text}]
+
+    return metadata
+
+
+def lookup(path):
+    """
+    Return the upstream metadata of the metadata.xml file at path, or
+    None if it doesn't exist. Raises ParseError for invalid files
+    """
+    global _dirty
+
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    index = _load_index()
+    key = os.path.abspath(path)
+    entry = index.get(key)
+    if entry is None or entry[0] != st.st_mtime_ns or entry[1] != st.st_size:
+        metadata = parse_upstream(xml.etree.ElementTree.parse(path).getroot())
+        entry = index[key] = [st.st_mtime_ns, st.st_size, metadata]
+        _dirty = True
+
+    # Handlers are free to modify their options
+    return copy.deepcopy(entry[2])
@@ -0,0 +1,236 @@
+# Copyright 2020-2024 src_prepare group
+# Distributed under the terms of the GNU General Public License v2
+
+"""
+Rank the mirrors of thirdpartymirrors by measured latency and error
+rate, so that mirror:// urls are resolved to the fastest healthy mirror.
+Measurements are kept in the cache directory between runs.
+"""
+
+import atexit
+import concurrent.futures
+import random
+import threading
+import time
+import urllib.parse
+
+import portage
+
+from euscan import CONFIG, budget, cache
+
+# Weight of the latest measurement in the moving averages
+ALPHA = 0.3
+
+# Mirrors with a higher error rate are only used when no other is left
+MAX_ERROR_RATE = 0.5
+
+# Mirrors probed at once when a group has no fresh measurements
+PROBES = 8
+
+# {name: [mirror urls]}, {host: [mirror urls]} and {mirror url: [names]}
+_mirrors = None
+_hosts = {}
+_groups = {}
+
+# {mirror url: {"latency": seconds, "errors": rate, "checked": timestamp}}
+_stats = None
+_dirty = False
+_probed = set()
+_failures = {}
+_lock = threading.Lock()
+
+
+def load_mirrors():
+    global _mirrors
+    if _mirrors is None:
+        _mirrors = {
+            name: [mirror.rstrip("/") for mirror in mirrors]
+            for name, mirrors in portage.settings.thirdpartymirrors().items()
+        }
+        # Spread the load among unmeasured mirrors, consistently in a run
+        for mirrors in _mirrors.values():
+            random.shuffle(mirrors)
+        for name, mirrors in _mirrors.items():
+            for mirror in mirrors:
+                host = urllib.parse.urlsplit(mirror).netloc
+                if mirror not in _groups:
+                    _hosts.setdefault(host, []).append(mirror)
+                _groups.setdefault(mirror, []).append(name)
+    return _mirrors
+
+
+def _load_stats():
+    global _stats
+    if _stats is None:
+        _stats = cache.load_json("mirrors.json") or {}
+        atexit.register(save_stats)
+    return _stats
+
+
+def save_stats():
+    global _dirty
+    if _dirty:
+        cache.store_json("mirrors.json", _stats)
+        _dirty = False
+
+
+def reset():
+    """
+    Save and forget the mirrors measurements and failures of this run
+    """
+    global _stats
+    save_stats()
+    atexit.unregister(save_stats)
+    with _lock:
+        _stats = None
+        _probed.clear()
+        _failures.clear()
+
+
+def mirror_of(url):
+    """
+    Return the mirror url serving url, or None
+    """
+    for mirror in _hosts.get(urllib.parse.urlsplit(url).netloc, ()):
+        if url.startswith(mirror + "/"):
+            return mirror
+    return None
+
+
+def record(mirror, latency=None):
+    """
+    Record a request to mirror, which failed when latency is None
+    """
+    global _dirty
+
+    stats = _load_stats()
+    with _lock:
+        if latency is None:
+            _failures[mirror] = _failures.get(mirror, 0) + 1
+        entry = stats.setdefault(mirror, {"latency": None, "errors": 0.0})
+        entry["errors"] = (1 - ALPHA) * entry["errors"] + ALPHA * (latency is None)
+        if latency is not None:
+            if entry["latency"] is None:
+                entry["latency"] = latency
+            else:
+                entry["latency"] = (1 - ALPHA) * entry["latency"] + ALPHA * latency
+        entry["checked"] = time.time()
+        _dirty = True
+
+
+def record_url(url, latency=None):
+    mirror = mirror_of(url)
+    if mirror:
+        record(mirror, latency)
+
+
+def failures(url):
+    """
+    Number of failed requests to the mirror serving url during this run
+    """
+    return _failures.get(mirror_of(url), 0)
+
+
+def _probe(mirror):
+    from euscan import helpers
+
+    # urlopen() records the outcome
+    try:
+        fp = helpers.urlopen(
+            mirror + "/", timeout=CONFIG["mirror-probe-timeout"], verb="HEAD"
+        )
+    except OSError:
+        return
+    if fp:
+        fp.close()
+
+
+def probe(name):
+    """
+    Measure the mirrors of name without fresh measurements, a few at a time
+    """
+    _probed.add(name)
+    stats = _load_stats()
+    now = time.time()
+    stale = [
+        mirror
+        for mirror in load_mirrors().get(name, [])
+        if mirror.startswith(("http://", "https://"))
+        and now - stats.get(mirror, {}).get("checked", 0) > CONFIG["mirror-stats-ttl"]
+    ]
+    if not stale:
+        return
+
+    stale = random.sample(stale, min(PROBES, len(stale)))
+    with concurrent.futures.ThreadPoolExecutor(len(stale)) as executor:
+        list(executor.map(_probe, stale))
+    save_stats()
+
+
+def _score(mirror, stats):
+    entry = stats.get(mirror)
+    if entry is None or entry["latency"] is None:
+        # Unknown mirrors after measured ones
+        return (entry is not None and entry["errors"] > MAX_ERROR_RATE, 1, 0)
+    unhealthy = entry["errors"] > MAX_ERROR_RATE
+    return (unhealthy, 0, entry["latency"] * (1 + entry["errors"]))
+
+
+def _probe_once(names):
+    """
+    Probe the groups of names not probed yet, unless a budget is exhausted
+    """
+    if budget.exceeded():
+        return
+
+    with _lock:
+        names = [name for name in names if name not in _probed]
+        _probed.update(names)
+    for name in names:
+        probe(name)
+
+
+def fetching(url):
+    """
+    Probe the mirrors of the groups of the mirror serving url, the first
+    time one of their urls is fetched
+    """
+    mirror = mirror_of(url)
+    if mirror is not None:
+        _probe_once(_groups.get(mirror, ()))
+
+
+def ranked(name):
+    """
+    Mirrors of name, fastest healthy ones first
+    """
+    mirrors = list(load_mirrors().get(name, []))
+    if not mirrors:
+        return []
+
+    stats = _load_stats()
+
+    return sorted(mirrors, key=lambda mirror: _score(mirror, stats))
+
+
+def split(uri):
+    """
+    Split mirror://name/path into (name, path), or return None
+    """
+    if not uri.startswith("mirror://"):
+        return None
+
+    eidx = uri.find("/", 9)
+    if eidx == -1:
+        return None
+    return uri[9:eidx], uri[eidx + 1 :]
+
+
+def resolve(uri):
+    """
+    Return the urls of a mirror:// uri on each mirror, best first. The
+    mirrors of a group are probed the first time one of its uris is resolved
+    """
+    name, path = split(uri)
+    _probe_once([name])
+    return [f"{mirror}/{path}" for mirror in ranked(name)]
@@ -6,17 +6,16 @@ import json
 import re
 import signal
 import sys
+import tempfile
 import time
-from collections import defaultdict
 from io import StringIO
 
 import portage
 from gentoolkit import pprinter as pp
 from portage.output import EOutput, TermProgressBar
 
-from euscan.helpers import dict_to_xml
-
-mirrors_ = None
+from euscan import mirrors
+from euscan.helpers import output_writer
 
 
 class ProgressHandler:
@@ -107,42 +106,24 @@ def to_ebuild_uri(cpv, url):
     return url
 
 
-def load_mirrors():
-    import random
-
-    global mirrors_
-    if mirrors_ is None:
-        mirrors_ = portage.settings.thirdpartymirrors()
-    for mirror_name in mirrors_:
-        random.shuffle(mirrors_[mirror_name])
-
-
 def from_mirror(url):
     if not url.startswith("mirror://"):
         return url
 
-    if not mirrors_:
-        load_mirrors()
+    split = mirrors.split(url)
+    if split is None or split[0] not in mirrors.load_mirrors():
+        return url
 
-    for mirror_name in mirrors_:
-        prefix = "mirror://" + mirror_name
-        if url.startswith(prefix):
-            return url.replace(prefix, mirrors_[mirror_name][0])
-
-    return url
+    urls = mirrors.resolve(url)
+    return urls[0] if urls else url
 
 
 def to_mirror(url):
-    if not mirrors_:
-        load_mirrors()
-
-    for mirror_name in mirrors_:
-        for mirror_url in mirrors_[mirror_name]:
-            if url.startswith(mirror_url):
-                url_part = url.split(mirror_url)[1]
-                return "mirror://{}{}{}".format(
-                    mirror_name, "" if url_part.startswith("/") else "/", url_part
-                )
+    for mirror_name, mirror_urls in mirrors.load_mirrors().items():
+        for mirror_url in mirror_urls:
+            if url.startswith(mirror_url + "/"):
+                url_part = url[len(mirror_url) :]
+                return f"mirror://{mirror_name}{url_part}"
     return url
 
 
@@ -162,21 +143,111 @@ class EOutputMem(EOutput):
         super()._write(self.out, msg)
 
 
+class Result:
+    """
+    An upstream version found for a query
+    """
+
+    __slots__ = ("version", "urls", "handler", "confidence", "type")
+
+    def __init__(self, version, urls, handler, confidence, type_):
+        self.version = version
+        self.urls = tuple(urls)
+        # Shared by thousands of results
+        self.handler = sys.intern(handler)
+        self.confidence = confidence
+        self.type = sys.intern(type_)
+
+    def as_dict(self):
+        return {
+            "version": self.version,
+            "urls": list(self.urls),
+            "handler": self.handler,
+            "confidence": self.confidence,
+            "type": self.type,
+        }
+
+
+class Query:
+    """
+    Results, metadata and messages of a query, the message buffer is
+    only created once something is written to it
+    """
+
+    __slots__ = ("output", "result", "metadata")
+
+    def __init__(self):
+        self.output = None
+        self.result = []
+        self.metadata = {}
+
+    def messages(self):
+        return self.output.getvalue() if self.output is not None else ""
+
+    def as_dict(self):
+        return {
+            "result": [result.as_dict() for result in self.result],
+            "metadata": self.metadata,
+            "messages": self.messages(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        query = cls()
+        query.result = [
+            Result(
+                result["version"],
+                result["urls"],
+                result["handler"],
+                result["confidence"],
+                result["type"],
+            )
+            for result in data["result"]
+        ]
+        query.metadata = data["metadata"]
+        if data["messages"]:
+            query.output = EOutputMem()
+            query.output.out.write(data["messages"])
+        return query
+
+
 class EuscanOutput:
     """
     Class that handles output for euscan
+
+    With the "spill" setting, finished queries are written to a temporary
+    file and only read back when formatting the output, or when they are
+    set again. Once stream() is called, they are directly written to the
+    output file instead, and can't be set again.
     """
 
     def __init__(self, config):
         self.config = config
-        self.queries = defaultdict(dict)
+        self.queries = {}
         self.current_query = None
+        self._eoutput = None
+        self._spill = None
+        # Offset of spilled queries in the spill file
+        self._spilled = {}
+        self._flushed = set()
+        self._writer = None
 
     def clean(self):
-        self.queries = defaultdict(dict)
+        self.queries = {}
         self.current_query = None
+        if self._spill is not None:
+            self._spill.close()
+        self._spill = None
+        self._spilled = {}
+        self._flushed = set()
 
     def set_query(self, query):
+        if self.current_query not in (None, query):
+            if self._writer is not None:
+                self.flush(self.current_query)
+            elif self.config.get("spill"):
+                self.spill(self.current_query)
+
         self.current_query = query
         if query is None:
             return
@@ -184,36 +255,85 @@ class EuscanOutput:
         if query in self.queries:
             return
 
-        if self.config["format"]:
-            output = EOutputMem()
-        else:
-            output = EOutput()
+        if query in self._flushed:
+            raise ValueError(f"Query {query} was already written")
 
-        self.queries[query] = {
-            "output": output,
-            "result": [],
-            "metadata": {},
-        }
+        if query in self._spilled:
+            # Results of the new scan are added to the spilled ones
+            self._spill.seek(self._spilled.pop(query))
+            self.queries[query] = Query.from_dict(json.loads(self._spill.readline()))
+            return
 
-    def get_formatted_output(self, format_=None):
-        data = {}
+        self.queries[query] = Query()
+
+    def spill(self, query):
+        """
+        Move a finished query from memory to the spill file
+        """
+        if query not in self.queries:
+            return
 
-        for query in self.queries:
-            data[query] = {
-                "result": self.queries[query]["result"],
-                "metadata": self.queries[query]["metadata"],
-                "messages": self.queries[query]["output"].getvalue(),
-            }
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile(
+                mode="w+", encoding="utf-8", prefix="euscan-"
+            )
+        self._spilled[query] = self._spill.seek(0, 2)
+        self._spill.write(json.dumps(self.queries.pop(query).as_dict()) + "\n")
+
+    def iter_queries(self):
+        """
+        Yield (query, data) for all queries, spilled ones first
+        """
+        for query, offset in self._spilled.items():
+            self._spill.seek(offset)
+            yield query, json.loads(self._spill.readline())
+
+        for query, data in self.queries.items():
+            yield query, data.as_dict()
+
+    def stream(self, fp, format_=None):
+        """
+        Write finished queries to fp as they complete, until
+        finish_stream() is called
+        """
+        self._writer = output_writer(
+            fp, format_ or self.config["format"], self.config["indent"]
+        )
+
+    def flush(self, query):
+        if query in self.queries:
+            self._writer.write(query, self.queries.pop(query).as_dict())
+            self._flushed.add(query)
+
+    def finish_stream(self, fp=None):
+        """
+        Write the remaining queries and close the stream, which is opened
+        on fp if stream() wasn't called
+        """
+        if self._writer is None:
+            self.stream(fp)
+        for query, data in self.iter_queries():
+            self._writer.write(query, data)
+        self._writer.close()
+        self._writer = None
+        self.clean()
+
+    def write_formatted_output(self, fp, format_=None):
+        writer = output_writer(
+            fp, format_ or self.config["format"], self.config["indent"]
+        )
+        for query, data in self.iter_queries():
+            writer.write(query, data)
+        writer.close()
 
+    def get_formatted_output(self, format_=None):
         format_ = format_ or self.config["format"]
-        if format_.lower() == "json":
-            return json.dumps(data, indent=self.config["indent"])
-        elif format_.lower() == "xml":
-            return dict_to_xml(data, indent=self.config["indent"])
-        elif format_.lower() == "dict":
-            return data
-        else:
-            raise TypeError("Invalid output format")
+        if format_.lower() == "dict":
+            return dict(self.iter_queries())
+
+        fp = StringIO()
+        self.write_formatted_output(fp, format_)
+        return fp.getvalue()
 
     def result(self, cp, version, urls, handler, confidence):
         from euscan.version import get_version_type
@@ -222,15 +342,14 @@ class EuscanOutput:
         urls = " ".join(transform_url(self.config, cpv, url) for url in urls.split())
 
         if self.config["format"] in ["json", "dict"]:
-            _curr = self.queries[self.current_query]
-            _curr["result"].append(
-                {
-                    "version": version,
-                    "urls": urls.split(),
-                    "handler": handler,
-                    "confidence": confidence,
-                    "type": get_version_type(version),
-                }
+            self.queries[self.current_query].result.append(
+                Result(
+                    version,
+                    urls.split(),
+                    handler,
+                    confidence,
+                    get_version_type(version),
+                )
             )
         else:
             if not self.config["quiet"]:
@@ -241,13 +360,28 @@ class EuscanOutput:
 
     def metadata(self, key, value, show=True):
         if self.config["format"]:
-            self.queries[self.current_query]["metadata"][key] = value
+            self.queries[self.current_query].metadata[key] = value
         elif show:
             print(f"{key.capitalize()}: {value}")
 
+    def _output(self):
+        if not self.config["format"]:
+            # Messages are printed right away, no need for one per query
+            if self._eoutput is None:
+                self._eoutput = EOutput()
+            return self._eoutput
+
+        if not self.config.get("messages", True):
+            return None
+
+        query = self.queries[self.current_query]
+        if query.output is None:
+            query.output = EOutputMem()
+        return query.output
+
     def __getattr__(self, key):
         if not self.config["quiet"] and self.current_query is not None:
-            output = self.queries[self.current_query]["output"]
-            return getattr(output, key)
-        else:
-            return lambda *x: None
+            output = self._output()
+            if output is not None:
+                return getattr(output, key)
+        return lambda *x: None
@@ -0,0 +1,188 @@
+# Copyright 2020-2024 src_prepare group
+# Distributed under the terms of the GNU General Public License v2
+
+"""
+Process-wide DNS cache and Happy Eyeballs (RFC 8305) connections for
+urllib, so that probing the same host many times doesn't resolve it
+every time, and broken IPv6 doesn't cost a full timeout per request.
+"""
+
+import errno
+import http.client
+import os
+import selectors
+import socket
+import threading
+import time
+import urllib.request
+
+from euscan import CONFIG, latency
+
+# Delay before trying the next address while a connection is pending
+CONNECTION_ATTEMPT_DELAY = 0.25
+
+# {(host, port): (expires, addresses or exception)}
+_cache = {}
+_lock = threading.Lock()
+
+
+def reset():
+    """
+    Forget the host name lookups done so far
+    """
+    with _lock:
+        _cache.clear()
+
+
+def getaddrinfo(host, port):
+    """
+    Cached socket.getaddrinfo() for TCP connections, failures are cached
+    for a shorter time
+    """
+    key = (host, port)
+    now = time.monotonic()
+
+    with _lock:
+        entry = _cache.get(key)
+    if entry is not None and entry[0] > now:
+        if isinstance(entry[1], Exception):
+            raise entry[1]
+        return entry[1]
+
+    try:
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        with _lock:
+            _cache[key] = (now + CONFIG["dns-negative-ttl"], e)
+        raise
+
+    with _lock:
+        _cache[key] = (now + CONFIG["dns-ttl"], addresses)
+    return addresses
+
+
+def _interleave(addresses):
+    """
+    Alternate address families, starting with the first one returned
+    """
+    families = {}
+    for address in addresses:
+        families.setdefault(address[0], []).append(address)
+
+    ordered = []
+    queues = list(families.values())
+    while queues:
+        for queue in queues:
+            ordered.append(queue.pop(0))
+        queues = [queue for queue in queues if queue]
+    return ordered
+
+
+def create_connection(
+    address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None
+):
+    """
+    Drop-in replacement for socket.create_connection(), starting a new
+    connection attempt every CONNECTION_ATTEMPT_DELAY seconds until one
+    of them succeeds
+    """
+    host, port = address[:2]
+    addresses = _interleave(getaddrinfo(host, port))
+
+    if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+        timeout = socket.getdefaulttimeout()
+
+    # Hosts usually quick to accept connections are given up on sooner
+    key = f"{host}:{port}"
+    connect_timeout = latency.connect_timeout(key, timeout)
+    if timeout is not None:
+        connect_timeout = min(connect_timeout, timeout)
+
+    start = time.monotonic()
+    deadline = start + connect_timeout if connect_timeout is not None else None
+
+    selector = selectors.DefaultSelector()
+    pending = []
+    error = None
+    next_attempt = 0
+
+    try:
+        while addresses or pending:
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                raise TimeoutError("timed out")
+
+            if addresses and (not pending or now >= next_attempt):
+                family, type_, proto, _, sockaddr = addresses.pop(0)
+                sock = socket.socket(family, type_, proto)
+                try:
+                    sock.setblocking(False)
+                    if source_address:
+                        sock.bind(source_address)
+                    err = sock.connect_ex(sockaddr)
+                    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                        raise OSError(err, os.strerror(err))
+                except OSError as e:
+                    sock.close()
+                    error = e
+                    # Failed attempts don't delay the next one (RFC 8305)
+                    next_attempt = now
+                    continue
+                selector.register(sock, selectors.EVENT_WRITE)
+                pending.append(sock)
+                next_attempt = now + CONNECTION_ATTEMPT_DELAY
+
+            wait = next_attempt - now if addresses else None
+            if deadline is not None:
+                remaining = deadline - now
+                wait = remaining if wait is None else min(wait, remaining)
+
+            for ready, _ in selector.select(wait):
+                sock = ready.fileobj
+                selector.unregister(sock)
+                pending.remove(sock)
+
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    sock.close()
+                    error = OSError(err, os.strerror(err))
+                    next_attempt = now
+                    continue
+
+                latency.record(key, "connect", time.monotonic() - start)
+                sock.settimeout(timeout)
+                return sock
+
+        if error is not None:
+            raise error
+        raise OSError("getaddrinfo returns an empty list")
+    finally:
+        for sock in pending:
+            sock.close()
+        selector.close()
+
+
+class HTTPConnection(http.client.HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = create_connection
+
+
+class HTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = create_connection
+
+
+class HTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(HTTPConnection, req)
+
+
+class HTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(
+            HTTPSConnection,
+            req,
+            context=self._context,
+        )
@@ -8,10 +8,12 @@ from datetime import datetime
 
 import gentoolkit.pprinter as pp
 import portage
+from gentoolkit.errors import GentoolkitException
 from gentoolkit.package import Package
 from gentoolkit.query import Query
+from portage.exception import PortageException
 
-from euscan import BLACKLIST_PACKAGES, CONFIG, handlers, output
+from euscan import BLACKLIST_PACKAGES, CONFIG, budget, handlers, output
 from euscan.ebuild import package_from_ebuild
 from euscan.helpers import version_blacklisted
 from euscan.out import from_mirror
@@ -86,9 +88,9 @@ def reload_gentoolkit():
         gentoolkit.query.PORTDB = portdb
 
 
-def scan_upstream(query, on_progress=None):
+def find_package(query, warn=True):
     """
-    Scans the upstream searching new versions for the given query
+    Find the package to scan for the given query
     """
     matches = []
 
@@ -104,7 +106,8 @@ def scan_upstream(query, on_progress=None):
         )
 
     if not matches:
-        output.ewarn(pp.warn("No package matching '%s'" % pp.pkgquery(query)))
+        if warn:
+            output.ewarn(pp.warn("No package matching '%s'" % pp.pkgquery(query)))
         return None
 
     matches = sorted(matches)
@@ -114,11 +117,71 @@ def scan_upstream(query, on_progress=None):
         pkg = matches.pop()
 
     if not pkg:
-        output.ewarn(
-            pp.warn("Package '%s' only have a dev version (9999)" % pp.pkgquery(pkg.cp))
-        )
+        if warn:
+            output.ewarn(
+                pp.warn(
+                    "Package '%s' only have a dev version (9999)" % pp.pkgquery(pkg.cp)
+                )
+            )
+        return None
+
+    return pkg
+
+
+def get_src_uris(uris):
+    # Roundabout way to handle $'' strings
+    uris = uris.encode("raw_unicode_escape").decode("unicode_escape")
+
+    return parse_src_uri(uris)
+
+
+def prefetch_upstream(queries):
+    """
+    Gives handlers a chance to batch their upstream queries
+    for all the given queries, returns the packages found by query
+    to be given to scan_upstream()
+    """
+    packages = {}
+    items = []
+
+    for query in queries:
+        # Resolving ebuilds messes with portage configuration
+        if query.endswith(".ebuild"):
+            continue
+
+        # Errors and warnings are reported when the query is scanned
+        try:
+            pkg = find_package(query, warn=False)
+            if not pkg:
+                continue
+            packages[query] = pkg
+            if pkg.cp in BLACKLIST_PACKAGES:
+                continue
+            items.append((pkg, get_src_uris(pkg.environment("SRC_URI"))))
+        except (GentoolkitException, PortageException):
+            continue
+
+    handlers.prefetch(items)
+    return packages
+
+
+def scan_upstream(query, on_progress=None, pkg=None):
+    """
+    Scans the upstream searching new versions for the given query,
+    or the package already found for it
+    """
+    if pkg is None:
+        pkg = find_package(query)
+    if not pkg:
         return None
 
+    return scan_package(pkg, on_progress)
+
+
+def scan_package(pkg, on_progress=None):
+    """
+    Scans the upstream searching new versions for the given package
+    """
     # useful data only for formatted output
     start_time = datetime.now()
     output.metadata("datetime", start_time.isoformat(), show=False)
@@ -153,18 +216,24 @@ def scan_upstream(query, on_progress=None):
     else:
         uris = pkg.environment("SRC_URI")
 
-    # Roundabout way to handle $'' strings
-    uris = uris.encode("raw_unicode_escape").decode("unicode_escape")
-
-    cpv = pkg.cpv
-
-    uris = parse_src_uri(uris)
+    uris = get_src_uris(uris)
     uris_expanded = [from_mirror(uri) if "mirror://" in uri else uri for uri in uris]
 
     pkg._uris = uris
     pkg._uris_expanded = uris_expanded
 
-    versions = handlers.scan(pkg, uris, on_progress)
+    with budget.limit(
+        "package", CONFIG["package-time-budget"], CONFIG["package-request-budget"]
+    ) as spent:
+        versions = handlers.scan(pkg, uris, on_progress)
+
+    if spent.exceeded:
+        output.ewarn("Budget exceeded for this package, results may be incomplete")
+
+    # Partial results are marked as such in formatted output
+    exhausted = budget.exhausted()
+    if exhausted:
+        output.metadata("budget_exceeded", exhausted, show=False)
 
     cp, ver, rev = portage.pkgsplit(pkg.cpv)
 